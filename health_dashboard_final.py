@@ -1,14 +1,72 @@
 # health_dashboard_final_v3.py
 import sys
 import os
+import re
+import random
+import shutil
 import sqlite3
+import tempfile
+import time
+import contextlib
+import json
+import math
+import queue
+import subprocess
+import zipfile
+import zlib
+import threading
+import multiprocessing
 import xml.etree.ElementTree as ET
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, jsonify, request, Response
+from itertools import groupby
+from pathlib import Path
+from urllib.parse import urlsplit
+from flask import Flask, jsonify, request, Response, abort, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
 
 # --- CONFIGURATION (No changes) ---
 DB_FILE = 'health.db'
 XML_FILE = 'export.xml'
+ZIP_FILE = 'export.zip'  # Imported directly when XML_FILE is not there
 IMPORT_WORKOUTS = True
 DATA_TYPES_TO_IMPORT = {
     'HKQuantityTypeIdentifierStepCount', 'HKQuantityTypeIdentifierActiveEnergyBurned', 'HKQuantityTypeIdentifierBasalEnergyBurned',
@@ -17,92 +75,1802 @@ DATA_TYPES_TO_IMPORT = {
     'HKQuantityTypeIdentifierBodyTemperature', 'HKQuantityTypeIdentifierBloodPressureSystolic', 'HKQuantityTypeIdentifierBloodPressureDiastolic',
     'HKCategoryTypeIdentifierSleepAnalysis',
 }
+# Calendar days, weeks and months are counted in this IANA timezone (e.g. 'Europe/Berlin'),
+# or with None in each record's own UTC offset, i.e. wherever you were at the time.
+# 'import --timezone' overrides it and is remembered in the database.
+HOME_TIMEZONE = None
+# Sleep samples less than this far apart belong to the same session; a night is all sessions ending on one day.
+SLEEP_SESSION_GAP_MINUTES = 60
+# Tiered storage, switched on by the 'compact' command: samples of these high-frequency types
+# older than RAW_RETENTION_DAYS are replaced by per-minute min/max/mean/count rows, and those
+# older than MINUTE_RETENTION_DAYS by 5-minute rows.
+TIERED_TYPES = {
+    'HKQuantityTypeIdentifierHeartRate', 'HKQuantityTypeIdentifierStepCount',
+    'HKQuantityTypeIdentifierActiveEnergyBurned', 'HKQuantityTypeIdentifierBasalEnergyBurned',
+}
+RAW_RETENTION_DAYS = 90
+MINUTE_RETENTION_DAYS = 730
+# Profiles: every subdirectory of PROFILES_DIR is one person's own health.db (and export.xml or
+# export.zip), imported with '--profile NAME' and served on /u/NAME/ next to the default DB_FILE.
+PROFILES_DIR = 'profiles'
+PROFILE = None  # The profile DB_FILE belongs to; set by --profile
+
+# --- INSTRUMENTATION ---
+# Request, query and import timings, served in the Prometheus text format on /metrics.
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_SECONDS = 0.25
+SERVER_TIMING = False
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms keyed by metric name and label pairs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = (kind, text)
+
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            self.values[name, labels] = self.values.get((name, labels), 0) + amount
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.values[name, labels] = value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = [0] * (len(HISTOGRAM_BUCKETS) + 2)
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+        described = set()
+        def header(name):
+            if name not in described and name in self.kinds:
+                kind, text = self.kinds[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS, histogram):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram[-1]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
+metrics.describe('health_http_requests_total', 'counter', 'HTTP requests by endpoint and status.')
+metrics.describe('health_http_requests_in_flight', 'gauge', 'Requests being handled right now; compare with the server thread count to spot queueing.')
+metrics.describe('health_http_request_duration_seconds', 'histogram', 'Time from the start of a request to its response, by endpoint.')
+metrics.describe('health_http_response_bytes_total', 'counter', 'Response body bytes by endpoint.')
+metrics.describe('health_json_duration_seconds', 'histogram', 'Time spent serializing JSON responses, by endpoint.')
+metrics.describe('health_db_query_duration_seconds', 'histogram', 'Execute plus fetch time of each SQL statement.')
+metrics.describe('health_db_query_rows_total', 'counter', 'Rows returned by each SQL statement.')
+metrics.describe('health_db_slow_queries_total', 'counter', 'Statements slower than the slow query threshold.')
+metrics.describe('health_query_cache_hits_total', 'counter', 'API query cache hits.')
+metrics.describe('health_query_cache_misses_total', 'counter', 'API query cache misses.')
+metrics.describe('health_query_cache_entries', 'gauge', 'Results held in the API query cache.')
+metrics.describe('health_import_phase_seconds', 'gauge', 'Time the last import spent in each phase.')
+
+_statement_labels = {}
+
+def record_query(sql, parameters, seconds, rows):
+    """Records one statement's timing and row count, and logs it if it was slow."""
+    statement = _statement_labels.get(sql)
+    if statement is None:
+        statement = _statement_labels[sql] = ' '.join(sql.split())
+    labels = (('statement', statement),)
+    metrics.observe('health_db_query_duration_seconds', labels, seconds)
+    metrics.inc('health_db_query_rows_total', labels, rows)
+    if has_request_context():
+        g.db_seconds = g.get('db_seconds', 0) + seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        metrics.inc('health_db_slow_queries_total', labels)
+        print(f"Slow query ({seconds * 1000:.0f} ms, {rows} rows): {statement} {tuple(parameters)}", file=sys.stderr)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's execute plus fetch time and row count to record_query()."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self.statement = (sql, parameters, time.perf_counter() - started)
+        self.streamed = 0
+        return self
+
+    def fetchmany(self, size=None):
+        # Streamed statements are recorded once, when the last chunk has been fetched.
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        sql, parameters, elapsed = self.statement
+        self.statement = (sql, parameters, elapsed + time.perf_counter() - started)
+        self.streamed += len(rows)
+        if not rows:
+            record_query(sql, parameters, self.statement[2], self.streamed)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_query(*self.statement[:2], self.statement[2] + time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_query(*self.statement[:2], self.statement[2] + time.perf_counter() - started, int(row is not None))
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+class PhaseTimer:
+    """Adds up wall time per import phase."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    def total(self):
+        return sum(self.seconds.values())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def timed(self, name, iterable):
+        """Yields from iterable, counting the time spent producing each item towards phase `name`."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            item = next(iterator, StopIteration)
+            self.add(name, time.perf_counter() - started)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        return ', '.join(f"{name} {seconds:.1f}s" for name, seconds in self.seconds.items())
+
+import_timer = PhaseTimer()
+
+# --- DATABASE AND IMPORTER LOGIC ---
+SCHEMA_VERSION = 5
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+IMPORT_BATCH_SIZE = 5000
+IMPORT_CHUNK_SIZE = 32 * 1024 * 1024  # Bytes of export.xml parsed and committed at a time
+IMPORT_READ_AHEAD = 2  # Chunks read (and decompressed) in the background while the previous ones are imported
+EXPORT_MEMBER = 'apple_health_export/export.xml'
+INSERT_QUERY = 'INSERT OR IGNORE INTO samples (type_id, ts, value, source_id, unit_id, tz_offset, day) VALUES (?, ?, ?, ?, ?, ?, ?)'
+# Week keys count Monday-based weeks from 1969-12-29, month keys are year * 12 + month - 1.
+WEEK_KEY_SQL = '(day + 3) / 7'
+MONTH_KEY_SQL = "CAST(strftime('%Y', day * 86400, 'unixepoch') AS INTEGER) * 12 + CAST(strftime('%m', day * 86400, 'unixepoch') AS INTEGER) - 1"
+# Recomputes daily_rollup from samples, bucketed by each sample's local calendar day.
+ROLLUP_QUERY = f'''
+    INSERT OR REPLACE INTO daily_rollup (type_id, day, week, month, sum_value, avg_value, min_value, max_value, sample_count)
+    SELECT type_id, day, {WEEK_KEY_SQL}, {MONTH_KEY_SQL}, SUM(value), AVG(value), MIN(value), MAX(value), COUNT(*) FROM samples'''
+# Bucket width in seconds of each compacted tier, finest first, and the query moving the rows of
+# one type before a cut-off into it from the next finer tier. Buckets merge with rows already there.
+TIER_TABLES = {'samples_1m': 60, 'samples_5m': 300}
+TIER_QUERIES = {
+    'samples_1m': '''
+        INSERT INTO samples_1m (type_id, ts, day, tz_offset, min_value, max_value, sum_value, sample_count)
+        SELECT type_id, ts / 60 * 60, MIN(day), MIN(tz_offset), MIN(value), MAX(value), SUM(value), COUNT(*) FROM samples
+        WHERE type_id = ? AND ts < ? GROUP BY ts / 60''',
+    'samples_5m': '''
+        INSERT INTO samples_5m (type_id, ts, day, tz_offset, min_value, max_value, sum_value, sample_count)
+        SELECT type_id, ts / 300 * 300, MIN(day), MIN(tz_offset), MIN(min_value), MAX(max_value), SUM(sum_value), SUM(sample_count) FROM samples_1m
+        WHERE type_id = ? AND ts < ? GROUP BY ts / 300''',
+}
+TIER_UPSERT = '''
+    ON CONFLICT (type_id, ts) DO UPDATE SET min_value = MIN(min_value, excluded.min_value), max_value = MAX(max_value, excluded.max_value),
+        sum_value = sum_value + excluded.sum_value, sample_count = sample_count + excluded.sample_count'''
+# daily_rollup rows of a tiered type, recomputed from all three tiers: (type_id, first ts, end ts) for
+# each tier, then the first and last day to write.
+TIER_ROLLUP_QUERY = f'''
+    INSERT OR REPLACE INTO daily_rollup (type_id, day, week, month, sum_value, avg_value, min_value, max_value, sample_count)
+    SELECT type_id, day, {WEEK_KEY_SQL}, {MONTH_KEY_SQL}, SUM(sum_value), SUM(sum_value) / SUM(sample_count), MIN(min_value), MAX(max_value), SUM(sample_count)
+    FROM (SELECT type_id, day, value AS sum_value, value AS min_value, value AS max_value, 1 AS sample_count FROM samples WHERE type_id = ? AND ts >= ? AND ts < ?
+          UNION ALL SELECT type_id, day, sum_value, min_value, max_value, sample_count FROM samples_1m WHERE type_id = ? AND ts >= ? AND ts < ?
+          UNION ALL SELECT type_id, day, sum_value, min_value, max_value, sample_count FROM samples_5m WHERE type_id = ? AND ts >= ? AND ts < ?)
+    GROUP BY day HAVING day BETWEEN ? AND ?'''
+# UTC offset in minutes of a version 1 start_date such as '2024-01-31 07:15:00+01:00'.
+V1_OFFSET_SQL = "(CASE substr(start_date, -6, 1) WHEN '-' THEN -1 ELSE 1 END) * (CAST(substr(start_date, -5, 2) AS INTEGER) * 60 + CAST(substr(start_date, -2) AS INTEGER))"
+
+# Top-level elements the importer may split the file in front of.
+SPLIT_TAGS = (b'Record', b'Correlation', b'Workout', b'ActivitySummary')
+FIRST_ELEMENT_RE = re.compile(rb'<HealthData[^>]*>.*?\n([ \t]*)<(?:Record|Correlation|Workout|ActivitySummary)\s', re.S)
+
+def create_schema(conn):
+    cursor = conn.cursor()
+    # Samples refer to types, units and sources by small integer ids instead of repeating the strings.
+    for table in ('record_types', 'units', 'sources'):
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    # ts is epoch seconds (UTC), tz_offset the sample's UTC offset in minutes and day its local
+    # calendar day counted from 1970-01-01 (see local_day()). Clustering on (type_id, ts) turns every per-type
+    # range scan into a contiguous read, and the full key rejects duplicate records.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS samples (
+            type_id INTEGER NOT NULL, ts INTEGER NOT NULL, value REAL NOT NULL, source_id INTEGER NOT NULL,
+            unit_id INTEGER, tz_offset INTEGER NOT NULL, day INTEGER NOT NULL,
+            PRIMARY KEY (type_id, ts, value, source_id)) WITHOUT ROWID''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            type_id INTEGER NOT NULL, day INTEGER NOT NULL, week INTEGER NOT NULL, month INTEGER NOT NULL,
+            sum_value REAL NOT NULL, avg_value REAL NOT NULL,
+            min_value REAL NOT NULL, max_value REAL NOT NULL, sample_count INTEGER NOT NULL,
+            PRIMARY KEY (type_id, day)) WITHOUT ROWID''')
+    # Compacted tiers of TIERED_TYPES: one row per type and minute or 5 minutes starting at ts,
+    # with the bucket's local day and UTC offset (the smallest, should they change within it).
+    # Every sample is in exactly one of samples, samples_1m and samples_5m; see compact_storage().
+    for table in TIER_TABLES:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                type_id INTEGER NOT NULL, ts INTEGER NOT NULL, day INTEGER NOT NULL, tz_offset INTEGER NOT NULL,
+                min_value REAL NOT NULL, max_value REAL NOT NULL, sum_value REAL NOT NULL, sample_count INTEGER NOT NULL,
+                PRIMARY KEY (type_id, ts)) WITHOUT ROWID''')
+    # One row per night, keyed by the local day of waking up; see update_sleep_nights().
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sleep_nights (
+            night INTEGER PRIMARY KEY, bedtime INTEGER NOT NULL, wake_time INTEGER NOT NULL, tz_offset INTEGER NOT NULL,
+            source_id INTEGER NOT NULL, deep_minutes REAL NOT NULL, core_minutes REAL NOT NULL, rem_minutes REAL NOT NULL,
+            unspecified_minutes REAL NOT NULL, awake_minutes REAL NOT NULL, asleep_minutes REAL NOT NULL)''')
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    # high_water_mark is the newest ts of each type as of the last completed import;
+    # pending_mark tracks the import in progress and is folded in when it completes.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_state (
+            type_id INTEGER PRIMARY KEY, high_water_mark INTEGER, pending_mark INTEGER)''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_checkpoint (
+            id INTEGER PRIMARY KEY CHECK (id = 1), xml_file TEXT NOT NULL, file_size INTEGER NOT NULL,
+            file_mtime REAL NOT NULL, byte_offset INTEGER NOT NULL, records INTEGER NOT NULL)''')
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
-# --- DATABASE AND IMPORTER LOGIC (No changes) ---
 def init_db():
     print("Initializing database...")
     with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS health_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, record_type TEXT NOT NULL, unit TEXT,
-                record_value REAL NOT NULL, start_date TIMESTAMP NOT NULL)''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_type_date ON health_data (record_type, start_date)')
+        create_schema(conn)
     print("Database initialized successfully.")
 
-def parse_and_import():
-    if not os.path.exists(XML_FILE):
-        print(f"Error: {XML_FILE} not found. Please place it in the same directory.")
+def needs_migration(path=None):
+    """True if path (by default DB_FILE) was created by an older version: the version 1 health_data table, or an older user_version."""
+    path = path or DB_FILE
+    if not os.path.exists(path):
+        return False
+    with sqlite3.connect(path) as conn:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'health_data'").fetchone() is not None:
+            return True
+        return 0 < conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION
+
+def migrate_db():
+    """Converts a version 1 database to the current schema in place."""
+    if not needs_migration():
+        print("Database is already up to date.")
         return
-    init_db()
-    print(f"Starting import of {XML_FILE}. This may take a very long time...")
-    context = ET.iterparse(XML_FILE, events=('end',))
-    records_batch = []
-    batch_size = 5000
-    count = 0
     with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM health_data")
-        if cursor.fetchone()[0] > 0:
-            print("Database already contains data. Skipping import. To re-import, delete the health.db file.")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'health_data'").fetchone() is None:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            try:
+                set_home_timezone(stored_timezone(conn))
+            except ValueError as error:
+                print(f"Error: {error}")
+                return
+            print(f"Migrating {DB_FILE} to schema version {SCHEMA_VERSION}...")
+            if version < 3:
+                # Version 2 lacks the week and month keys of daily_rollup.
+                conn.execute('DROP TABLE daily_rollup')
+            create_schema(conn)
+            if version < 3:
+                rebuild_daily_rollup(conn)
+            update_sleep_nights(conn)
+            bump_data_version(conn)
+            print("Migration complete!")
             return
-        for event, elem in context:
-            tag = elem.tag
-            if tag == 'Record':
-                record_type = elem.get('type')
-                if record_type in DATA_TYPES_TO_IMPORT:
-                    try:
-                        if record_type == 'HKCategoryTypeIdentifierSleepAnalysis':
-                            sleep_stage_type = elem.get('value')
-                            start_date = datetime.strptime(elem.get('startDate'), '%Y-%m-%d %H:%M:%S %z')
-                            end_date = datetime.strptime(elem.get('endDate'), '%Y-%m-%d %H:%M:%S %z')
-                            duration_minutes = (end_date - start_date).total_seconds() / 60
-                            records_batch.append((sleep_stage_type, 'min', duration_minutes, start_date))
-                            count += 1
-                        else:
-                            value = float(elem.get('value'))
-                            unit = elem.get('unit')
-                            start_date = datetime.strptime(elem.get('startDate'), '%Y-%m-%d %H:%M:%S %z')
-                            records_batch.append((record_type, unit, value, start_date))
-                            count += 1
-                    except (ValueError, TypeError, AttributeError):
-                        pass
-            elif tag == 'Workout' and IMPORT_WORKOUTS:
-                try:
-                    energy_burned_elem = elem.find('TotalEnergyBurned')
-                    if energy_burned_elem is not None:
-                        value = float(energy_burned_elem.get('value'))
-                        unit = energy_burned_elem.get('unit')
-                        start_date = datetime.strptime(elem.get('startDate'), '%Y-%m-%d %H:%M:%S %z')
-                        records_batch.append(('HKQuantityTypeIdentifierActiveEnergyBurned', unit, value, start_date))
-                        count += 1
-                except (ValueError, TypeError, AttributeError):
-                    pass
-            if len(records_batch) >= batch_size:
-                cursor.executemany('INSERT INTO health_data (record_type, unit, record_value, start_date) VALUES (?, ?, ?, ?)', records_batch)
-                conn.commit()
-                print(f"Imported {count} records...")
-                records_batch = []
-            if tag in ['Record', 'Workout', 'ActivitySummary']:
+    size_before = os.path.getsize(DB_FILE)
+    print(f"Migrating {DB_FILE} to the compact schema. This may take a while...")
+    with sqlite3.connect(DB_FILE) as conn:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(health_data)')]
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        conn.execute('DROP TABLE IF EXISTS daily_rollup')
+        if 'import_state' in tables:
+            conn.execute('ALTER TABLE import_state RENAME TO import_state_v1')
+        create_schema(conn)
+        rows = f"""SELECT record_type, unit, record_value, {'source' if 'source' in columns else "''"} AS source,
+                          CAST(strftime('%s', start_date) AS INTEGER) AS ts, {V1_OFFSET_SQL} AS tz_offset FROM health_data"""
+        legacy = 'source' not in columns
+        if legacy:
+            # Imported before sources were recorded. Copies of one sample from several devices
+            # can't be told apart, so the n-th copy gets the placeholder source 'unknown source n'
+            # instead of collapsing into one row; the next import replaces them (see parse_and_import()).
+            rows = f"""SELECT record_type, unit, record_value, 'unknown source ' || ROW_NUMBER() OVER (
+                              PARTITION BY record_type, ts, record_value) AS source, ts, tz_offset FROM ({rows})"""
+        conn.execute('INSERT OR IGNORE INTO record_types (name) SELECT DISTINCT record_type FROM health_data')
+        conn.execute('INSERT OR IGNORE INTO units (name) SELECT DISTINCT unit FROM health_data WHERE unit IS NOT NULL')
+        conn.execute(f'INSERT OR IGNORE INTO sources (name) SELECT DISTINCT source FROM ({rows})')
+        conn.execute(f'''
+            INSERT OR IGNORE INTO samples (type_id, ts, value, source_id, unit_id, tz_offset, day)
+            SELECT t.id, h.ts, h.record_value, s.id, u.id, h.tz_offset, (h.ts + h.tz_offset * 60) / 86400
+            FROM ({rows}) AS h
+            JOIN record_types AS t ON t.name = h.record_type
+            JOIN sources AS s ON s.name = h.source
+            LEFT JOIN units AS u ON u.name = h.unit''')
+        if legacy or conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_rows'").fetchone():
+            # Also a version 1 database whose first import since sources were recorded hasn't completed.
+            sources = [source_id for source_id, in conn.execute("SELECT id FROM sources WHERE name GLOB 'unknown source *'")]
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_rows', ?)", [json.dumps(sources)])
+        if 'import_state' in tables:
+            conn.execute('''
+                INSERT INTO import_state (type_id, high_water_mark, pending_mark)
+                SELECT t.id, CAST(strftime('%s', o.high_water_mark) AS INTEGER), CAST(strftime('%s', o.pending_mark) AS INTEGER)
+                FROM import_state_v1 AS o JOIN record_types AS t ON t.name = o.record_type''')
+            conn.execute('DROP TABLE import_state_v1')
+        elif not legacy:
+            conn.execute('INSERT INTO import_state (type_id, high_water_mark) SELECT type_id, MAX(ts) FROM samples GROUP BY type_id')
+        # Legacy rows get no high-water marks: the next import has to read every record again.
+        conn.execute('DROP TABLE health_data')
+        rebuild_daily_rollup(conn)
+        update_sleep_nights(conn)
+        bump_data_version(conn)
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('VACUUM')
+    conn.close()
+    print(f"Migration complete! {format_bytes(size_before)} -> {format_bytes(os.path.getsize(DB_FILE))}")
+
+def bump_data_version(conn):
+    """Marks the data as changed, invalidating API caches and ETags once the transaction commits."""
+    conn.execute("INSERT INTO meta (key, value) VALUES ('data_version', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+_home_zone = None
+_zone_offsets = {}
+
+def parse_timezone(name):
+    """Returns the ZoneInfo for an IANA name, or None for None/'sample' (each record's own offset)."""
+    if name in (None, '', 'sample'):
+        return None
+    if ZoneInfo is None:
+        raise ValueError("timezones need Python 3.9 or newer")
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"unknown timezone '{name}' (on Windows, pip install tzdata)")
+
+def set_home_timezone(name):
+    """Selects the timezone local_day() counts days in: an IANA name, or None/'sample' for each record's own offset."""
+    global _home_zone
+    _home_zone = parse_timezone(name)
+    _zone_offsets.clear()
+
+def local_day(ts, tz_offset):
+    """Returns the calendar day key (days since 1970-01-01) of a sample taken at ts with the given UTC offset in minutes."""
+    if _home_zone is None:
+        return (ts + tz_offset * 60) // 86400
+    # Offsets only change on quarter hours, so one lookup serves every sample in the same quarter.
+    quarter = ts // 900
+    offset = _zone_offsets.get(quarter)
+    if offset is None:
+        if len(_zone_offsets) > 100000:
+            _zone_offsets.clear()
+        offset = _zone_offsets[quarter] = int(datetime.fromtimestamp(quarter * 900, _home_zone).utcoffset().total_seconds())
+    return (ts + offset) // 86400
+
+def stored_timezone(conn):
+    """Returns the home timezone the database's days are counted in, or None if it was never set."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'home_timezone'").fetchone()
+    return row[0] if row else None
+
+def rekey_days(conn, name):
+    """Switches the database to another home timezone (set_home_timezone() first), recomputing every day key."""
+    print(f"Counting calendar days in timezone '{name}'...")
+    conn.create_function('local_day', 2, local_day, deterministic=True)
+    conn.execute('UPDATE samples SET day = local_day(ts, tz_offset)')
+    for table in TIER_TABLES:
+        conn.execute(f'UPDATE {table} SET day = local_day(ts, tz_offset)')
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('home_timezone', ?)", [name])
+    rebuild_daily_rollup(conn)
+    update_sleep_nights(conn)
+    bump_data_version(conn)
+
+def period_start(period, key):
+    """Returns the first day of a week or month key."""
+    if period == 'week':
+        return key * 7 - 3
+    return day_number(datetime(key // 12, key % 12 + 1, 1))
+
+def period_totals(rows, period, aggregate):
+    """Folds (period key, sum, count) rollup rows, ordered by day, into one (x, value, label) row per week or month."""
+    series = []
+    for key, group in groupby(rows, key=lambda row: row[0]):
+        total = count = 0
+        for _, sum_value, sample_count in group:
+            total += sum_value
+            count += sample_count
+        day = period_start(period, key)
+        label = (EPOCH + timedelta(days=day)).strftime('%Y-%m-%d')
+        series.append((day * 86400, total if aggregate == 'sum' else total / count, label))
+    return series
+
+def rebuild_daily_rollup(conn):
+    conn.execute('DELETE FROM daily_rollup')
+    conn.execute(ROLLUP_QUERY + ' GROUP BY type_id, day')
+    if storage_tiers(conn) is not None:
+        # Compacted types keep their older samples in the tiers.
+        for type_id in tiered_type_ids(conn):
+            update_tier_rollup(conn, type_id)
+
+def update_tier_rollup(conn, type_id, first=-2**31, last=2**31):
+    """Recomputes the daily_rollup days first to last of a compacted type from all three tiers."""
+    # A local day lies within a day either side of the same UTC day.
+    span = [type_id, (first - 1) * 86400, (last + 2) * 86400]
+    conn.execute(TIER_ROLLUP_QUERY, span * 3 + [first, last])
+
+def update_daily_rollup(conn, samples):
+    """Recomputes the daily_rollup days touched by a batch of imported samples."""
+    spans = {}
+    for sample in samples:
+        type_id, day = sample[0], sample[6]
+        first, last = spans.get(type_id, (day, day))
+        spans[type_id] = (min(first, day), max(last, day))
+    tiered = set(tiered_type_ids(conn)) if storage_tiers(conn) is not None else set()
+    for type_id, (first, last) in spans.items():
+        if type_id in tiered:
+            # The day the raw samples start at can also have compacted ones.
+            update_tier_rollup(conn, type_id, first, last)
+            continue
+        # A local day lies within a day either side of the same UTC day.
+        conn.execute(
+            ROLLUP_QUERY + ' WHERE type_id = ? AND ts >= ? AND ts < ? GROUP BY day HAVING day BETWEEN ? AND ?',
+            [type_id, (first - 1) * 86400, (last + 2) * 86400, first, last])
+
+# Sleep stages and their sleep_nights columns, in the order that wins where one source's samples overlap.
+SLEEP_STAGE_COLUMNS = {
+    'HKCategoryValueSleepAnalysisAsleepDeep': 'deep_minutes',
+    'HKCategoryValueSleepAnalysisAsleepREM': 'rem_minutes',
+    'HKCategoryValueSleepAnalysisAsleepCore': 'core_minutes',
+    'HKCategoryValueSleepAnalysisAsleepUnspecified': 'unspecified_minutes',
+    'HKCategoryValueSleepAnalysisAsleep': 'unspecified_minutes',
+    'HKCategoryValueSleepAnalysisAwake': 'awake_minutes',
+}
+SLEEP_COLUMNS = ('deep_minutes', 'core_minutes', 'rem_minutes', 'unspecified_minutes', 'awake_minutes')
+
+def sleep_sessions(intervals, gap):
+    """Splits (start, end, stage, source_id, tz_offset) intervals sorted by start wherever nothing covers gap seconds."""
+    session, session_end = [], None
+    for interval in intervals:
+        if session and interval[0] > session_end + gap:
+            yield session
+            session = []
+        if not session or interval[1] > session_end:
+            session_end = interval[1]
+        session.append(interval)
+    if session:
+        yield session
+
+def session_minutes(session):
+    """Returns the minutes per SLEEP_COLUMNS of a session, counting every overlapped second once.
+
+    Where sources overlap (say iPhone and Watch), the one with the most staged sleep wins;
+    within one source the stage that comes first in SLEEP_STAGE_COLUMNS wins.
+    """
+    staged = {}
+    for start, end, stage, source_id, _ in session:
+        if SLEEP_STAGE_COLUMNS[stage] in ('deep_minutes', 'core_minutes', 'rem_minutes'):
+            staged[source_id] = staged.get(source_id, 0) + end - start
+        else:
+            staged.setdefault(source_id, 0)
+    rank = {source_id: i for i, source_id in enumerate(sorted(staged, key=lambda source_id: -staged[source_id]))}
+    priority = {stage: i for i, stage in enumerate(SLEEP_STAGE_COLUMNS)}
+    events = []
+    for start, end, stage, source_id, _ in session:
+        key = (rank[source_id], priority[stage], SLEEP_STAGE_COLUMNS[stage])
+        events.append((start, 1, key))
+        events.append((end, -1, key))
+    events.sort()
+    minutes = dict.fromkeys(SLEEP_COLUMNS, 0.0)
+    active, previous = {}, None
+    for moment, change, key in events:
+        if active and moment > previous:
+            minutes[min(active)[2]] += (moment - previous) / 60
+        active[key] = active.get(key, 0) + change
+        if not active[key]:
+            del active[key]
+        previous = moment
+    return minutes
+
+def update_sleep_nights(conn, first_day=None, last_day=None):
+    """Recomputes the sleep_nights rows of the nights first_day to last_day (all nights if omitted) from the sleep samples."""
+    stages = list(SLEEP_STAGE_COLUMNS)
+    query = f'''
+        SELECT s.ts, s.ts + CAST(s.value * 60 AS INTEGER), t.name, s.source_id, s.tz_offset FROM samples s
+        JOIN record_types t ON t.id = s.type_id WHERE t.name IN ({','.join('?' for _ in stages)})'''
+    if first_day is None:
+        intervals = conn.execute(query, stages).fetchall()
+        conn.execute('DELETE FROM sleep_nights')
+    else:
+        # A night's sessions start at most a day before it and end before the next one is over.
+        intervals = conn.execute(query + ' AND s.ts >= ? AND s.ts < ?', stages + [(first_day - 2) * 86400, (last_day + 2) * 86400]).fetchall()
+        conn.execute('DELETE FROM sleep_nights WHERE night BETWEEN ? AND ?', [first_day, last_day])
+    intervals.sort()
+    nights = {}
+    for session in sleep_sessions(intervals, SLEEP_SESSION_GAP_MINUTES * 60):
+        minutes = session_minutes(session)
+        asleep = minutes['deep_minutes'] + minutes['core_minutes'] + minutes['rem_minutes'] + minutes['unspecified_minutes']
+        last = max(session, key=lambda interval: interval[1])
+        night = local_day(last[1], last[4])
+        if first_day is not None and not first_day <= night <= last_day:
+            continue
+        # Bedtime, wake time and source are the longest session's; naps only add their minutes.
+        row = {'bedtime': session[0][0], 'wake_time': last[1], 'tz_offset': last[4], 'source_id': last[3], 'asleep_minutes': asleep, **minutes}
+        if night in nights:
+            main, other = (row, nights[night]) if asleep > nights[night]['asleep_minutes'] else (nights[night], row)
+            for column in SLEEP_COLUMNS + ('asleep_minutes',):
+                main[column] += other[column]
+            row = main
+        nights[night] = row
+    columns = ('bedtime', 'wake_time', 'tz_offset', 'source_id') + SLEEP_COLUMNS + ('asleep_minutes',)
+    conn.executemany(f'INSERT INTO sleep_nights (night, {", ".join(columns)}) VALUES ({", ".join("?" * (len(columns) + 1))})',
+                     [[night] + [row[column] for column in columns] for night, row in nights.items()])
+
+def storage_tiers(conn):
+    """Returns the tiered storage settings saved by compact_storage(), or None if every raw sample is kept."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'storage_tiers'").fetchone()
+    return json.loads(row[0]) if row else None
+
+def tiered_type_ids(conn):
+    names = sorted(TIERED_TYPES)
+    return [row[0] for row in conn.execute(f"SELECT id FROM record_types WHERE name IN ({','.join('?' * len(names))})", names)]
+
+def compact_storage(conn, raw_days, minute_days):
+    """Moves samples of TIERED_TYPES older than raw_days into the minute tier, and minute rows older than minute_days into the 5-minute tier.
+
+    Cut-offs fall on UTC midnights with a day to spare and never move back, since compacted
+    samples cannot be restored. The settings are saved for later imports. Returns the number
+    of samples compacted, or None if the database still holds migrated rows without sources.
+    """
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_rows'").fetchone():
+        # The next import replaces those rows in samples only; their compacted copies would be counted twice.
+        print("Error: this database was migrated from an older version. Run the 'import' command once before compacting it.")
+        return None
+    tiers = storage_tiers(conn) or {'raw_cutoff': 0, 'minute_cutoff': 0}
+    today = int(time.time()) // 86400
+    tiers.update(raw_days=raw_days, minute_days=minute_days,
+                 raw_cutoff=max(tiers['raw_cutoff'], (today - raw_days - 1) * 86400),
+                 minute_cutoff=max(tiers['minute_cutoff'], (today - minute_days - 1) * 86400))
+    compacted = 0
+    for type_id in tiered_type_ids(conn):
+        conn.execute(TIER_QUERIES['samples_1m'] + TIER_UPSERT, [type_id, tiers['raw_cutoff']])
+        compacted += conn.execute('DELETE FROM samples WHERE type_id = ? AND ts < ?', [type_id, tiers['raw_cutoff']]).rowcount
+        conn.execute(TIER_QUERIES['samples_5m'] + TIER_UPSERT, [type_id, tiers['minute_cutoff']])
+        conn.execute('DELETE FROM samples_1m WHERE type_id = ? AND ts < ?', [type_id, tiers['minute_cutoff']])
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('storage_tiers', ?)", [json.dumps(tiers)])
+    bump_data_version(conn)
+    return compacted
+
+def compact_db(raw_days=None, minute_days=None):
+    """The 'compact' command: switches on tiered storage, or applies it again with new retention windows."""
+    if not os.path.exists(DB_FILE):
+        print(f"Database file '{DB_FILE}' not found. Run the 'import' command first.")
+        return
+    if needs_migration():
+        migrate_db()
+    size_before = os.path.getsize(DB_FILE)
+    with sqlite3.connect(DB_FILE) as conn:
+        tiers = storage_tiers(conn) or {}
+        raw_days = raw_days or tiers.get('raw_days', RAW_RETENTION_DAYS)
+        minute_days = max(minute_days or tiers.get('minute_days', MINUTE_RETENTION_DAYS), raw_days)
+        compacted = compact_storage(conn, raw_days, minute_days)
+    if compacted is None:
+        return
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('VACUUM')
+    conn.close()
+    print(f"Compacted {compacted} samples older than {raw_days} days into per-minute rows (5-minute rows after {minute_days} days).")
+    print(f"{format_bytes(size_before)} -> {format_bytes(os.path.getsize(DB_FILE))}")
+
+_offset_cache = {}
+
+def parse_timestamp(value):
+    """Parses an export timestamp like '2024-01-31 07:15:00 +0100' into (epoch seconds, UTC offset in minutes).
+
+    Equivalent to datetime.strptime(value, DATE_FORMAT), but remembers the offsets already
+    seen and lets fromisoformat do the rest, which is several times faster.
+    """
+    offset = _offset_cache.get(value[20:])
+    if offset is None or len(value) != 25 or value[19] != ' ':
+        parsed = datetime.strptime(value, DATE_FORMAT)
+        offset = int(parsed.utcoffset().total_seconds()) // 60
+        if len(value) == 25:
+            _offset_cache[value[20:]] = offset
+        return int(parsed.timestamp()), offset
+    return (datetime.fromisoformat(value[:19]) - EPOCH) // SECOND - offset * 60, offset
+
+def element_to_row(elem):
+    """Converts a parsed Record or Workout element into a (type, unit, value, ts, tz_offset, source) row, or None to skip it."""
+    tag = elem.tag
+    if tag == 'Record':
+        record_type = elem.get('type')
+        if record_type in DATA_TYPES_TO_IMPORT:
+            try:
+                if record_type == 'HKCategoryTypeIdentifierSleepAnalysis':
+                    sleep_stage_type = elem.get('value')
+                    start_ts, tz_offset = parse_timestamp(elem.get('startDate'))
+                    end_ts, _ = parse_timestamp(elem.get('endDate'))
+                    duration_minutes = (end_ts - start_ts) / 60
+                    return (sleep_stage_type, 'min', duration_minutes, start_ts, tz_offset, elem.get('sourceName', ''))
+                value = float(elem.get('value'))
+                unit = elem.get('unit')
+                start_ts, tz_offset = parse_timestamp(elem.get('startDate'))
+                return (record_type, unit, value, start_ts, tz_offset, elem.get('sourceName', ''))
+            except (ValueError, TypeError, AttributeError):
+                pass
+    elif tag == 'Workout' and IMPORT_WORKOUTS:
+        try:
+            energy_burned_elem = elem.find('TotalEnergyBurned')
+            if energy_burned_elem is not None:
+                value = float(energy_burned_elem.get('value'))
+                unit = energy_burned_elem.get('unit')
+                start_ts, tz_offset = parse_timestamp(elem.get('startDate'))
+                return ('HKQuantityTypeIdentifierActiveEnergyBurned', unit, value, start_ts, tz_offset, elem.get('sourceName', ''))
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return None
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+def current_rss():
+    """Returns the resident set size of this process in bytes, or None if it cannot be determined."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return peak_rss()
+
+def peak_rss(children=False):
+    """Returns the peak resident set size of this process (or of its finished children) in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def format_bytes(value):
+    return '?' if value is None else f"{value / 2**20:,.0f} MB"
+
+def parse_size(value):
+    """Parses a size such as '512M' or '2G' into bytes."""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def check_memory(max_rss):
+    if max_rss:
+        rss = current_rss()
+        if rss is not None and rss > max_rss:
+            raise MemoryLimitExceeded(f"Process {os.getpid()} uses {format_bytes(rss)}, above the --max-rss limit of {format_bytes(max_rss)}.")
+
+_high_water_marks = {}
+_max_rss = None
+
+def init_import_worker(marks, max_rss=None):
+    """Sets the per-type cut-off below which parsed records are dropped and the memory ceiling (also a Pool initializer)."""
+    global _high_water_marks, _max_rss
+    _high_water_marks = marks
+    _max_rss = max_rss
+
+def is_new(row):
+    mark = _high_water_marks.get(row[0])
+    return mark is None or row[3] >= mark
+
+class CountingReader:
+    """File wrapper that remembers how far into the file on disk the last read or seek went."""
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.position = self.f.tell()
+        return data
+
+    def seek(self, offset, whence=0):
+        self.position = self.f.seek(offset, whence)
+        return self.position
+
+    def tell(self):
+        return self.f.tell()
+
+    def seekable(self):
+        return True
+
+@contextlib.contextmanager
+def open_export(path):
+    """Opens an export.xml, or the export.xml inside an export.zip, which is decompressed as it is read.
+
+    Yields (stream, progress, total): progress() returns how many of the total bytes of the
+    file on disk (for a zip, of the compressed member) have been consumed so far.
+    """
+    with open(path, 'rb') as f:
+        counter = CountingReader(f)
+        if not zipfile.is_zipfile(f):
+            f.seek(0)
+            yield counter, lambda: counter.position, os.fstat(f.fileno()).st_size
+            return
+        with zipfile.ZipFile(counter) as archive:
+            members = [info for info in archive.infolist() if info.filename == EXPORT_MEMBER]
+            members = members or [info for info in archive.infolist() if os.path.basename(info.filename) == 'export.xml']
+            if not members:
+                raise zipfile.BadZipFile(f"no {EXPORT_MEMBER} in the archive")
+            info = members[0]
+            with archive.open(info) as stream:
+                yield stream, lambda: min(max(counter.position - info.header_offset, 0), info.compress_size), info.compress_size
+
+def read_ahead(iterable, depth=IMPORT_READ_AHEAD):
+    """Yields the items of iterable, producing up to depth of them in advance in a background thread."""
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as error:
+            put((False, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+class ProgressBar:
+    """Redraws one status line on a terminal, or prints a line per update when the output is redirected."""
+
+    def __init__(self, total, width=30, interval=0.2):
+        self.total = total
+        self.width = width
+        self.interval = interval
+        self.started = time.monotonic()
+        self.first = None
+        self.drawn = 0
+
+    def update(self, done, count):
+        now = time.monotonic()
+        if self.first is None:
+            self.first = done
+        terminal = sys.stdout.isatty()
+        if terminal and now - self.drawn < self.interval and done < self.total:
+            return
+        self.drawn = now
+        fraction = min(done / self.total, 1) if self.total else 1
+        filled = int(fraction * self.width)
+        rate = (done - self.first) / max(now - self.started, 1e-9)
+        eta = f", {(self.total - done) / rate:,.0f}s left" if rate > 0 and done < self.total else ''
+        line = (f"[{'#' * filled}{'.' * (self.width - filled)}] {fraction:6.1%} {format_bytes(done)} of {format_bytes(self.total)}, "
+                f"{count:,} records (RSS {format_bytes(current_rss())}){eta}")
+        if terminal:
+            sys.stdout.write('\r' + line.ljust(120))
+            sys.stdout.flush()
+        else:
+            print(line)
+
+    def close(self):
+        if self.drawn and sys.stdout.isatty():
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        self.drawn = 0
+
+def open_xml_chunks(stream, start_offset=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Returns a generator of (end_offset, block) pairs where each block holds only complete top-level elements.
+
+    Blocks are cut in front of a top-level <Record>, <Correlation>, <Workout> or
+    <ActivitySummary> start tag, recognised by the indentation Apple uses for children of
+    <HealthData>, so nested records (e.g. inside a Correlation) never straddle a cut.
+    end_offset is where the next block starts and can be passed back as start_offset
+    to resume. Returns None if the file does not have that layout.
+    """
+    head = stream.read(chunk_size)
+    match = FIRST_ELEMENT_RE.search(head)
+    if match is None:
+        return None
+    markers = [b'\n' + match.group(1) + b'<' + tag + b' ' for tag in SPLIT_TAGS]
+    position = match.start(1) - 1
+    buffer = head[position:]
+    if start_offset is not None and start_offset > position:
+        stream.seek(start_offset)
+        position, buffer = start_offset, b''
+    return _generate_xml_chunks(stream, position, buffer, markers, chunk_size)
+
+def _generate_xml_chunks(stream, position, buffer, markers, chunk_size):
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        buffer += block
+        cut = max(buffer.rfind(marker) for marker in markers)
+        if cut > 0:
+            position += cut
+            yield position, buffer[:cut]
+            buffer = buffer[cut:]
+    end = buffer.rfind(b'</HealthData>')
+    if end >= 0:
+        buffer = buffer[:end]
+    if buffer.strip():
+        yield position + len(buffer), buffer
+
+class ChunkReader:
+    """Read-only file object over a block wrapped in <HealthData> tags, so the block is never copied."""
+
+    def __init__(self, chunk):
+        self.parts = deque([b'<HealthData>', memoryview(chunk), b'</HealthData>'])
+
+    def read(self, size=-1):
+        while self.parts and not self.parts[0]:
+            self.parts.popleft()
+        if not self.parts:
+            return b''
+        part = self.parts[0]
+        if size < 0 or size >= len(part):
+            self.parts.popleft()
+            return bytes(part)
+        self.parts[0] = part[size:]
+        return bytes(part[:size])
+
+def iter_export_rows(source):
+    """Yields element_to_row() rows from an export.xml file or file object.
+
+    Each top-level element is cleared and detached from <HealthData> once it has been
+    handled, whatever its tag, so memory use does not grow with the size of the export.
+    Uses lxml when it is installed, which is faster than the standard library parser.
+    """
+    if lxml_etree is not None:
+        for event, elem in lxml_etree.iterparse(source, events=('end',), tag=('Record', 'Workout')):
+            row = element_to_row(elem)
+            if row is not None:
+                yield row
+            parent = elem.getparent()
+            if parent is not None and parent.getparent() is None:
                 elem.clear()
-        if records_batch:
-            cursor.executemany('INSERT INTO health_data (record_type, unit, record_value, start_date) VALUES (?, ?, ?, ?)', records_batch)
+                # Also drops skipped siblings such as Correlation, ActivitySummary or Me.
+                while elem.getprevious() is not None:
+                    del parent[0]
+        return
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        row = element_to_row(elem)
+        if row is not None:
+            yield row
+        if depth == 1:
+            elem.clear()
+            root.remove(elem)
+
+def parse_xml_chunk(chunk):
+    """Worker entry point: parses one block from open_xml_chunks() into rows newer than the high-water marks."""
+    rows = [row for row in iter_export_rows(ChunkReader(chunk)) if is_new(row)]
+    check_memory(_max_rss)
+    return rows
+
+class LookupTable:
+    """Caches the name -> id mapping of one of the record_types, units and sources tables."""
+
+    def __init__(self, conn, table):
+        self.conn = conn
+        self.table = table
+        self.ids = {name: row_id for row_id, name in conn.execute(f'SELECT id, name FROM {table}')}
+
+    def __getitem__(self, name):
+        row_id = self.ids.get(name)
+        if row_id is None:
+            row_id = self.ids[name] = self.conn.execute(f'INSERT INTO {self.table} (name) VALUES (?)', (name,)).lastrowid
+        return row_id
+
+def load_high_water_marks(conn):
+    marks, pending = {}, {}
+    query = 'SELECT t.name, s.high_water_mark, s.pending_mark FROM import_state AS s JOIN record_types AS t ON t.id = s.type_id'
+    for record_type, high_water_mark, pending_mark in conn.execute(query):
+        if high_water_mark is not None:
+            marks[record_type] = high_water_mark
+        if pending_mark is not None:
+            pending[record_type] = pending_mark
+    return marks, pending
+
+def save_pending_marks(conn, types, pending, rows):
+    changed = {}
+    for row in rows:
+        mark = pending.get(row[0])
+        if mark is None or row[3] > mark:
+            pending[row[0]] = changed[row[0]] = row[3]
+    conn.executemany(
+        'INSERT INTO import_state (type_id, pending_mark) VALUES (?, ?) ON CONFLICT (type_id) DO UPDATE SET pending_mark = excluded.pending_mark',
+        [(types[record_type], mark) for record_type, mark in changed.items()])
+
+def write_rows(conn, tables, pending, rows):
+    """Inserts one batch of rows and returns how many of them were new."""
+    types, units, sources = tables
+    with import_timer.phase('convert'):
+        samples = [(types[record_type], ts, value, sources[source], None if unit is None else units[unit], tz_offset, local_day(ts, tz_offset))
+                   for record_type, unit, value, ts, tz_offset, source in rows]
+    with import_timer.phase('insert'):
+        before = conn.total_changes
+        conn.executemany(INSERT_QUERY, samples)
+        inserted = conn.total_changes - before
+        save_pending_marks(conn, types, pending, rows)
+    with import_timer.phase('rollup'):
+        update_daily_rollup(conn, samples)
+        sleep_days = [sample[6] for sample, row in zip(samples, rows) if row[0] in SLEEP_STAGE_COLUMNS]
+        if sleep_days:
+            # A sample can belong to the night of the day after it started, or, when the
+            # session's wake time has another UTC offset than the sample, of the day before.
+            update_sleep_nights(conn, min(sleep_days) - 1, max(sleep_days) + 1)
+        bump_data_version(conn)
+    return inserted
+
+def import_serial(conn, stream, tables, pending, progress, report):
+    """Fallback for exports open_xml_chunks() cannot split; cannot resume after an interruption."""
+    records_batch = []
+    count = 0
+    # Parsing is interleaved with writing here, so its time is what the other phases leave over.
+    started, timed = time.perf_counter(), import_timer.total()
+    for row in iter_export_rows(stream):
+        if is_new(row):
+            records_batch.append(row)
+        if len(records_batch) >= IMPORT_BATCH_SIZE:
+            count += write_rows(conn, tables, pending, records_batch)
+            with import_timer.phase('commit'):
+                conn.commit()
+            report.update(progress(), count)
+            check_memory(_max_rss)
+            records_batch = []
+    import_timer.add('parse', time.perf_counter() - started - (import_timer.total() - timed))
+    if records_batch:
+        count += write_rows(conn, tables, pending, records_batch)
+    return count
+
+def parse_chunks(chunks, workers):
+    """Yields (end_offset, rows) in file order, parsing in a process pool when workers > 1."""
+    chunks = import_timer.timed('read', chunks)
+    if workers <= 1:
+        for end_offset, chunk in chunks:
+            with import_timer.phase('parse'):
+                rows = parse_xml_chunk(chunk)
+            yield end_offset, rows
+        return
+    with multiprocessing.Pool(workers, initializer=init_import_worker, initargs=(_high_water_marks, _max_rss)) as pool:
+        # Bounded in-flight window: Pool.imap would read the whole file ahead of the writer.
+        pending = deque()
+        for end_offset, chunk in chunks:
+            pending.append((end_offset, pool.apply_async(parse_xml_chunk, (chunk,))))
+            while len(pending) >= workers * 2 or (pending and pending[0][1].ready()):
+                end_offset, result = pending.popleft()
+                # With workers, 'parse' is the time the writer waits for parsed blocks.
+                with import_timer.phase('parse'):
+                    rows = result.get()
+                yield end_offset, rows
+        while pending:
+            end_offset, result = pending.popleft()
+            with import_timer.phase('parse'):
+                rows = result.get()
+            yield end_offset, rows
+
+def import_chunks(conn, chunks, workers, checkpoint, tables, pending, count, progress, report):
+    """Writes each parsed block in its own transaction together with a resume checkpoint."""
+    for end_offset, rows in parse_chunks(chunks, workers):
+        count += write_rows(conn, tables, pending, rows)
+        with import_timer.phase('commit'):
+            conn.execute(
+                'INSERT OR REPLACE INTO import_checkpoint (id, xml_file, file_size, file_mtime, byte_offset, records) VALUES (1, ?, ?, ?, ?, ?)',
+                checkpoint + (end_offset, count))
             conn.commit()
-        print(f"Imported a total of {count} records.")
-    print("Import complete!")
+        report.update(progress(), count)
+        check_memory(_max_rss)
+    return count
+
+def parse_and_import(workers=1, max_rss=None, timezone=None, source=None):
+    """Imports new records from source (an export.xml or export.zip; by default XML_FILE, else ZIP_FILE)."""
+    source = source or (XML_FILE if os.path.exists(XML_FILE) or not os.path.exists(ZIP_FILE) else ZIP_FILE)
+    if not os.path.exists(source):
+        print(f"Error: {source} not found. Please place it (or {ZIP_FILE}) in the same directory.")
+        return
+    try:
+        set_home_timezone(timezone)
+    except ValueError as error:
+        print(f"Error: {error}")
+        return
+    if needs_migration():
+        migrate_db()
+    init_db()
+    print(f"Starting import of {source}. This may take a very long time...")
+    started = time.monotonic()
+    import_timer.seconds.clear()
+    stat = os.stat(source)
+    checkpoint = (os.path.abspath(source), stat.st_size, stat.st_mtime)
+    with sqlite3.connect(DB_FILE) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        current = stored_timezone(conn)
+        wanted = timezone or current or HOME_TIMEZONE or 'sample'
+        set_home_timezone(wanted)
+        if wanted != (current or 'sample'):
+            rekey_days(conn, wanted)
+        marks, pending = load_high_water_marks(conn)
+        tiers = storage_tiers(conn)
+        if tiers is not None:
+            # Samples before the raw cut-off were compacted, and INSERT OR IGNORE only sees the raw
+            # samples: re-reading them would add them to the tiers a second time.
+            for name in TIERED_TYPES:
+                marks[name] = max(marks.get(name, 0), tiers['raw_cutoff'])
+        init_import_worker(marks, max_rss)
+        tables = (LookupTable(conn, 'record_types'), LookupTable(conn, 'units'), LookupTable(conn, 'sources'))
+        start_offset, count = None, 0
+        row = conn.execute('SELECT xml_file, file_size, file_mtime, byte_offset, records FROM import_checkpoint').fetchone()
+        if row is not None and tuple(row[:3]) == checkpoint:
+            start_offset, count = row[3], row[4]
+            print(f"Resuming interrupted import at byte {start_offset:,} ({count} records already imported).")
+        if workers > 1:
+            print(f"Using {workers} worker processes.")
+        report = None
+        try:
+            with open_export(source) as (stream, progress, total):
+                report = ProgressBar(total)
+                chunks = open_xml_chunks(stream, start_offset)
+                if chunks is not None:
+                    with contextlib.closing(read_ahead(chunks)) as chunks:
+                        count = import_chunks(conn, chunks, workers, checkpoint, tables, pending, count, progress, report)
+                else:
+                    print("Could not split the export into chunks, importing in a single pass.")
+                    stream.seek(0)
+                    count = import_serial(conn, stream, tables, pending, progress, report)
+                report.close()
+        except zipfile.BadZipFile as error:
+            conn.rollback()
+            if report is not None:
+                report.close()
+            print(f"Error: cannot read {source}: {error}")
+            return
+        except KeyboardInterrupt:
+            conn.rollback()
+            if report is not None:
+                report.close()
+            print("Import interrupted. Run the import command again to resume from the last committed batch.")
+            return
+        except MemoryLimitExceeded as error:
+            conn.rollback()
+            if report is not None:
+                report.close()
+            print(f"Error: {error} Import stopped; run it again (with a smaller --workers) to resume.")
+            return
+        row = conn.execute("SELECT value FROM meta WHERE key = 'legacy_rows'").fetchone()
+        if row is not None:
+            # Rows migrated from before sources were recorded have placeholder sources. This import
+            # read every record again (they had no high-water marks); drop the ones it re-added with their real source.
+            legacy = json.loads(row[0])
+            placeholders = ', '.join('?' * len(legacy))
+            deleted = conn.execute(f'''
+                DELETE FROM samples WHERE source_id IN ({placeholders}) AND EXISTS (
+                    SELECT 1 FROM samples AS new WHERE new.type_id = samples.type_id AND new.ts = samples.ts
+                    AND new.value = samples.value AND new.source_id NOT IN ({placeholders}))''', legacy + legacy).rowcount
+            count -= deleted
+            if deleted:
+                rebuild_daily_rollup(conn)
+                update_sleep_nights(conn)
+                bump_data_version(conn)
+            conn.execute("DELETE FROM meta WHERE key = 'legacy_rows'")
+        conn.execute('UPDATE import_state SET high_water_mark = pending_mark, pending_mark = NULL WHERE pending_mark IS NOT NULL')
+        conn.execute('DELETE FROM import_checkpoint')
+        tiers = storage_tiers(conn)
+        if tiers is not None:
+            compacted = compact_storage(conn, tiers['raw_days'], tiers['minute_days'])
+            if compacted:
+                print(f"Compacted {compacted} samples older than {tiers['raw_days']} days.")
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('import_phase_seconds', ?)", [json.dumps(import_timer.seconds)])
+        print(f"Imported a total of {count} new records.")
+    elapsed = time.monotonic() - started
+    print(f"Import complete! ({elapsed:.1f}s, {count / max(elapsed, 1e-9):,.0f} records/sec)")
+    print(f"Time by phase: {import_timer.summary()}")
+    workers_rss = f", {format_bytes(peak_rss(children=True))} largest worker" if workers > 1 else ''
+    print(f"Peak memory: {format_bytes(peak_rss())} importer{workers_rss} ({'lxml' if lxml_etree is not None else 'xml.etree'} parser).")
+    return count
+
+# --- DOWNSAMPLING ---
+# Raw series can hold hundreds of thousands of samples; /api/data?points=N or ?resolution=
+# reduces them to roughly what a chart can actually draw.
+RESOLUTION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+MIN_RESOLUTION = 1  # Timestamps are whole seconds; narrower buckets would only overflow x // width
+
+def parse_resolution(value):
+    """Parses a bucket width such as '300', '5m', '1h' or '1d' into seconds."""
+    value = value.strip().lower()
+    if value and value[-1] in RESOLUTION_UNITS:
+        seconds = float(value[:-1]) * RESOLUTION_UNITS[value[-1]]
+    else:
+        seconds = float(value)
+    if not math.isfinite(seconds) or seconds < MIN_RESOLUTION:
+        raise ValueError(value)
+    return seconds
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets: keeps the threshold points that best preserve the shape of the series.
+
+    points is a list of (x, y, label) tuples sorted by x; the selected tuples are returned.
+    """
+    if threshold < 3 or len(points) <= threshold:
+        return points
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    selected = 0
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+        ax, ay = points[selected][0], points[selected][1]
+        best_area = -1
+        for j in range(int(i * every) + 1, next_start):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best_area, selected = area, j
+        sampled.append(points[selected])
+    sampled.append(points[-1])
+    return sampled
+
+def bucket_series(points, width, mode, origin=0):
+    """Reduces (x, y, label) points to one mean point, or a min and a max point, per bucket of width x units."""
+    result = []
+    bucket = []
+    for point in points + [None]:
+        if bucket and (point is None or (point[0] - origin) // width != (bucket[0][0] - origin) // width):
+            if mode == 'mean':
+                result.append((bucket[0][0], sum(p[1] for p in bucket) / len(bucket), bucket[0][2]))
+            else:
+                low = min(bucket, key=lambda p: p[1])
+                high = max(bucket, key=lambda p: p[1])
+                result.extend(sorted({id(low): low, id(high): high}.values(), key=lambda p: p[0]))
+            bucket = []
+        if point is not None:
+            bucket.append(point)
+    return result
+
+def downsample(series, points=None, resolution=None, mode='lttb'):
+    """Downsamples a list of (x, y, label) tuples sorted by x (epoch seconds).
+
+    points caps the number of tuples (LTTB, or per-bucket min/max or mean over points
+    equal-width buckets); resolution instead sets the bucket width in seconds.
+    """
+    if not series or (points is not None and len(series) <= points):
+        return series
+    if resolution is not None:
+        return bucket_series(series, max(resolution, MIN_RESOLUTION), mode)
+    if mode == 'lttb':
+        return lttb(series, points)
+    buckets = points // 2 if mode == 'minmax' else points
+    width = (series[-1][0] - series[0][0]) / max(buckets, 1) or 1
+    return bucket_series(series, width, mode, origin=series[0][0])
+
+# --- COLUMNAR EXPORT AND ANALYTICS ---
+# 'export' writes the samples as Parquet or Arrow files, one directory per type
+# (type=<name>/part-0.parquet), which pandas, polars, DuckDB or pyarrow.dataset read directly.
+# 'serve --analytics DIR' maps an Arrow export into memory and answers /api/data and
+# /api/summary from it with NumPy instead of SQLite, as long as it matches the database.
+EXPORT_CHUNK_ROWS = 65536
+EXPORT_MANIFEST = '_export.json'  # leading underscore: dataset readers skip it
+EXPORT_QUERY = '''
+    SELECT s.ts, s.value, s.tz_offset, s.day, src.name, u.name
+    FROM samples s JOIN sources src ON src.id = s.source_id LEFT JOIN units u ON u.id = s.unit_id
+    WHERE s.type_id = ? ORDER BY s.ts'''
+
+SLEEP_EXPORT_FILE = '_sleep_nights'
+SLEEP_EXPORT_QUERY = f'''
+    SELECT n.night, n.bedtime, n.wake_time, n.tz_offset, src.name, {', '.join('n.' + column for column in SLEEP_COLUMNS)}, n.asleep_minutes
+    FROM sleep_nights n JOIN sources src ON src.id = n.source_id ORDER BY n.night'''
+
+def export_schema():
+    return pa.schema([
+        ('ts', pa.timestamp('s', tz='UTC')), ('value', pa.float64()), ('tz_offset', pa.int16()),
+        ('day', pa.date32()), ('source', pa.string()), ('unit', pa.string()),
+    ])
+
+def sleep_export_schema():
+    return pa.schema([
+        ('night', pa.date32()), ('bedtime', pa.timestamp('s', tz='UTC')), ('wake_time', pa.timestamp('s', tz='UTC')),
+        ('tz_offset', pa.int16()), ('source', pa.string()),
+    ] + [(column, pa.float64()) for column in SLEEP_COLUMNS + ('asleep_minutes',)])
+
+def write_table(path, rows, schema, fmt):
+    """Writes rows (tuples in schema order) as one Parquet or Arrow file."""
+    table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)], schema=schema) if rows else schema.empty_table()
+    if fmt == 'parquet':
+        pq.write_table(table, path, compression='zstd')
+    else:
+        with pa.ipc.new_file(path, schema) as writer:
+            writer.write_table(table)
+
+def export_columnar(directory, fmt='parquet', chunk_rows=EXPORT_CHUNK_ROWS):
+    """Writes every type's samples to directory/type=<name>/part-0.<fmt>, chunk_rows rows per row group or batch.
+
+    directory must be new, empty or a previous export (it has a manifest), which is replaced.
+    """
+    if pa is None:
+        print("Error: exporting requires pyarrow. Please run: pip install pyarrow")
+        return
+    target = os.path.abspath(directory)
+    if target == os.getcwd() or os.path.abspath(DB_FILE).startswith(os.path.join(target, '')):
+        print(f"Error: {directory} holds the database; choose a new directory for the export.")
+        return
+    if os.path.exists(target) and not (os.path.isdir(target) and (os.path.exists(os.path.join(target, EXPORT_MANIFEST)) or not os.listdir(target))):
+        print(f"Error: {directory} exists and is not a previous export; choose a new or empty directory.")
+        return
+    schema = export_schema()
+    parent = os.path.dirname(target)
+    os.makedirs(parent, exist_ok=True)
+    # A fresh staging directory next to the target, so a failed export never touches existing files.
+    staging = tempfile.mkdtemp(prefix=os.path.basename(target) + '.', suffix='.tmp', dir=parent)
+    os.chmod(staging, 0o755)
+    try:
+        manifest = write_export(staging, fmt, chunk_rows, schema)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    print(f"Export complete: {sum(manifest['types'].values())} samples in {len(manifest['types'])} types written to {directory}/.")
+
+def write_export(staging, fmt, chunk_rows, schema):
+    """Writes the type=<name> files, the sleep nights and the manifest of an export into staging; returns the manifest."""
+    with sqlite3.connect(DB_FILE) as conn:
+        manifest = {'format': fmt, 'data_version': data_version(conn), 'exported_at': datetime.now().isoformat(timespec='seconds'), 'types': {}}
+        for type_id, name in conn.execute('SELECT id, name FROM record_types ORDER BY name').fetchall():
+            cursor = conn.execute(EXPORT_QUERY, [type_id])
+            writer, rows_written = None, 0
+            # fetchmany keeps one chunk in memory at a time, however many samples a type has.
+            for rows in iter(lambda: cursor.fetchmany(chunk_rows), []):
+                batch = pa.record_batch([pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)], schema=schema)
+                if writer is None:
+                    path = os.path.join(staging, f'type={name}', f'part-0.{fmt}')
+                    os.makedirs(os.path.dirname(path))
+                    writer = pq.ParquetWriter(path, schema, compression='zstd') if fmt == 'parquet' else pa.ipc.new_file(path, schema)
+                writer.write_batch(batch)
+                rows_written += len(rows)
+            if writer is not None:
+                writer.close()
+                manifest['types'][name] = rows_written
+                print(f"Exported {rows_written} {name} samples.")
+        # The leading underscore keeps dataset readers of the type= directories from picking it up.
+        nights = conn.execute(SLEEP_EXPORT_QUERY).fetchall()
+        write_table(os.path.join(staging, f'{SLEEP_EXPORT_FILE}.{fmt}'), nights, sleep_export_schema(), fmt)
+        manifest['sleep_nights'] = len(nights)
+        # Only the raw samples are exported; the analytics backend leaves types with compacted history to SQLite.
+        compacted = conn.execute('''
+            SELECT t.name, SUM(c.sample_count) FROM (SELECT type_id, sample_count FROM samples_1m UNION ALL SELECT type_id, sample_count FROM samples_5m) AS c
+            JOIN record_types AS t ON t.id = c.type_id GROUP BY t.name ORDER BY t.name''').fetchall()
+        manifest['compacted_types'] = [name for name, _ in compacted]
+        for name, samples in compacted:
+            print(f"[WARNING] {samples} {name} samples compacted by 'compact' are not in the export, only their per-minute and 5-minute rows in the database.")
+    with open(os.path.join(staging, EXPORT_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+class ColumnStore:
+    """Memory-mapped columns of an Arrow export, read as NumPy arrays without copying."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, EXPORT_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['format'] != 'arrow':
+            raise ValueError(f"{directory} holds a {manifest['format']} export; the analytics backend needs 'export --format arrow'.")
+        self.directory = directory
+        self.version = manifest['data_version']
+        self.compacted = set(manifest.get('compacted_types', ()))
+        self.batches = {}
+        self.sleep = None
+        self.lock = threading.Lock()
+
+    def load(self, record_type):
+        """Returns a list of (ts, value, day) array triples, one per record batch, sorted by ts."""
+        with self.lock:
+            batches = self.batches.get(record_type)
+            if batches is None:
+                batches = []
+                path = os.path.join(self.directory, f'type={record_type}', 'part-0.arrow')
+                if os.path.exists(path):
+                    reader = pa.ipc.open_file(pa.memory_map(path))
+                    for i in range(reader.num_record_batches):
+                        batch = reader.get_batch(i)
+                        batches.append((batch.column('ts').to_numpy().view(np.int64), batch.column('value').to_numpy(),
+                                        batch.column('day').view(pa.int32()).to_numpy()))
+                self.batches[record_type] = batches
+            return batches
+
+    def window(self, record_type, start_ts):
+        """Returns (ts, value, day) arrays of the samples at or after start_ts."""
+        parts = []
+        for ts, value, day in self.load(record_type):
+            if len(ts) and ts[-1] >= start_ts:
+                first = np.searchsorted(ts, start_ts)
+                parts.append((ts[first:], value[first:], day[first:]))
+        if not parts:
+            return np.empty(0, np.int64), np.empty(0, np.float64), np.empty(0, np.int32)
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def nights(self, start_day):
+        """Returns the asleep minutes of the exported nights from start_day on."""
+        with self.lock:
+            if self.sleep is None:
+                self.sleep = (np.empty(0, np.int32), np.empty(0))
+                path = os.path.join(self.directory, f'{SLEEP_EXPORT_FILE}.arrow')
+                if os.path.exists(path):
+                    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+                    if table.num_rows:
+                        self.sleep = (table.column('night').combine_chunks().view(pa.int32()).to_numpy(),
+                                      table.column('asleep_minutes').to_numpy())
+            night, asleep = self.sleep
+        return asleep[night >= start_day]
+
+    def days(self, record_type, start_day):
+        """Returns (value, day) arrays of the samples whose local day is start_day or later."""
+        # A sample's local day can start up to 14 hours before its UTC day.
+        ts, value, day = self.window(record_type, start_day * 86400 - 86400)
+        keep = day >= start_day
+        return value[keep], day[keep]
+
+def daily_totals(values, days):
+    """Returns (days, sums, counts) for the distinct days present, like daily_rollup."""
+    if not len(days):
+        return days, values, values
+    first = days.min()
+    counts = np.bincount(days - first)
+    sums = np.bincount(days - first, weights=values)
+    present = np.flatnonzero(counts)
+    return present + first, sums[present], counts[present]
+
+def lttb_indices(x, y, threshold):
+    """NumPy version of lttb(): returns the indices of the selected points."""
+    if threshold < 3 or len(x) <= threshold:
+        return np.arange(len(x))
+    selected = [0]
+    every = (len(x) - 2) / (threshold - 2)
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(x))
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        ax, ay = x[selected[-1]], y[selected[-1]]
+        start = int(i * every) + 1
+        area = np.abs((ax - avg_x) * (y[start:next_start] - ay) - (ax - x[start:next_start]) * (avg_y - ay))
+        selected.append(start + int(area.argmax()))
+    selected.append(len(x) - 1)
+    return np.array(selected)
+
+def bucket_indices(x, y, width, mode, origin=0):
+    """NumPy version of bucket_series(): returns (indices of the points kept, their values)."""
+    bucket = (x - origin) // width
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    if mode == 'mean':
+        return starts, np.add.reduceat(y, starts) / np.diff(np.r_[starts, len(y)])
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(y)]))
+    # First index of each bucket's minimum and maximum, as min() and max() pick them.
+    low = np.flatnonzero(y == np.minimum.reduceat(y, starts)[segment])
+    high = np.flatnonzero(y == np.maximum.reduceat(y, starts)[segment])
+    low = low[np.r_[True, segment[low][1:] != segment[low][:-1]]]
+    high = high[np.r_[True, segment[high][1:] != segment[high][:-1]]]
+    indices = np.unique(np.concatenate([low, high]))
+    return indices, y[indices]
+
+def downsample_arrays(x, y, points=None, resolution=None, mode='lttb'):
+    """NumPy version of downsample(): returns (indices of the points kept, their values)."""
+    if not len(x) or (points is not None and len(x) <= points) or not (points or resolution):
+        return np.arange(len(x)), y
+    if resolution is not None:
+        return bucket_indices(x, y, max(resolution, MIN_RESOLUTION), mode)
+    if mode == 'lttb':
+        indices = lttb_indices(x.astype(np.float64), y, points)
+        return indices, y[indices]
+    buckets = points // 2 if mode == 'minmax' else points
+    width = (x[-1] - x[0]) / max(buckets, 1) or 1
+    return bucket_indices(x, y, width, mode, origin=x[0])
+
+def period_arrays(days, sums, counts, period):
+    """NumPy version of period_totals(): returns (first day, sums, counts) per week or month."""
+    if period == 'week':
+        keys = (days + 3) // 7
+    else:
+        keys = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if period == 'week':
+        first = keys[starts] * 7 - 3
+    else:
+        first = keys[starts].astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    return first, np.add.reduceat(sums, starts), np.add.reduceat(counts, starts)
+
+def columnar_series(store, data_type, start_day, aggregate=None, points=None, resolution=None, mode='lttb', period='day', tiers=None):
+    """query_series() computed from a ColumnStore; None for types with compacted history, which only the database holds."""
+    if tiers is not None or data_type in store.compacted:
+        return None
+    if aggregate in ('sum', 'avg'):
+        days, sums, counts = daily_totals(*store.days(data_type, start_day))
+        if period != 'day' and len(days):
+            days, sums, counts = period_arrays(days, sums, counts, period)
+        x, y = days.astype(np.int64) * 86400, sums if aggregate == 'sum' else sums / counts
+        indices, y = downsample_arrays(x, y, points, resolution, mode)
+        labels = np.datetime_as_string(days[indices].astype('datetime64[D]'))
+    else:
+        x, y, _ = store.window(data_type, day_start_ts(start_day))
+        indices, y = downsample_arrays(x, y, points, resolution, mode)
+        labels = np.char.add(np.datetime_as_string(x[indices].astype('datetime64[s]'), unit='s'), 'Z')
+    return [{'start_date': label, 'record_value': value} for label, value in zip(labels.tolist(), y.tolist())]
+
+def columnar_summary(store, start_day):
+    """query_summary() computed from a ColumnStore; None if one of its types has compacted history."""
+    if store.compacted & {'HKQuantityTypeIdentifierRestingHeartRate', 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN',
+                          'HKQuantityTypeIdentifierStepCount'}:
+        return None
+    resting, _ = store.days('HKQuantityTypeIdentifierRestingHeartRate', start_day)
+    hrv, _ = store.days('HKQuantityTypeIdentifierHeartRateVariabilitySDNN', start_day)
+    _, steps, _ = daily_totals(*store.days('HKQuantityTypeIdentifierStepCount', start_day))
+    sleep = store.nights(start_day)
+    sleep = sleep[sleep > 0]
+    return {
+        'lowest_rhr': float(resting.min()) if len(resting) else None,
+        'avg_steps': float(steps.mean()) if len(steps) else None,
+        'highest_hrv': float(hrv.max()) if len(hrv) else None,
+        'avg_sleep_minutes': float(sleep.mean()) if len(sleep) else None,
+    }
+
+COLUMNAR_QUERIES = {'query_series': columnar_series, 'query_summary': columnar_summary}
 
 # --- FLASK WEB SERVER & API ---
 
+def day_number(value):
+    """Returns the day column value (days since 1970-01-01) for a date or datetime."""
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH.date()).days
+
+def home_zone():
+    """Returns the home timezone: the requested database's while serving, else the one set_home_timezone() selected."""
+    if has_request_context():
+        pool = get_pool()
+        return pool.home_zone(pool.connection())
+    return _home_zone
+
+def day_start_ts(day):
+    """Returns the epoch seconds of midnight starting a day, in the home timezone if one is set."""
+    return int((EPOCH + timedelta(days=day)).replace(tzinfo=home_zone()).timestamp())
+
+# Pragmas for the API's read connections: map the file into memory, keep a larger page
+# cache per connection and refuse writes.
+READ_PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -32000',
+    'PRAGMA temp_store = MEMORY',
+)
+STATEMENT_CACHE_SIZE = 256
+STREAM_CHUNK_ROWS = 5000
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_MAX_ROWS = 10000  # Larger series (e.g. points= beyond the raw sample count) are computed but not kept
+
+class QueryCache:
+    """Size-bounded LRU of API query results, emptied whenever the data version changes.
+
+    Holds at most capacity results of at most QUERY_CACHE_MAX_ROWS rows each.
+    """
+
+    def __init__(self, capacity=QUERY_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, conn, key, compute):
+        version = data_version(conn)
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            # Don't store a result computed from data an import has since replaced, or a huge one.
+            if version == self.version and not (isinstance(value, list) and len(value) > QUERY_CACHE_MAX_ROWS):
+                self.entries[key] = value
+                if len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'capacity': self.capacity, 'data_version': self.version}
+
+class ConnectionPool:
+    """Gives each server thread its own long-lived, read-only connection to one database.
+
+    Reusing connections keeps the page cache warm and the prepared statements cached
+    instead of paying for both on every request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.cache = QueryCache()
+        self.columns = None
+        self.zone = (None, None)
+        # WAL is stored in the file and lets requests read while an import writes.
+        try:
+            conn = sqlite3.connect(path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.close()
+        except sqlite3.OperationalError:
+            pass
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            uri = Path(self.path).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+                                   factory=InstrumentedConnection)
+            for pragma in READ_PRAGMAS:
+                conn.execute(pragma)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def home_zone(self, conn):
+        """Returns the timezone this database counts days in, read again whenever an import commits."""
+        version, zone = self.zone
+        if version != data_version(conn):
+            version = data_version(conn)
+            zone = parse_timezone(stored_timezone(conn))
+            self.zone = (version, zone)
+        return zone
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.local = threading.local()
+
+pools = {}
+PROFILE_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+def profile_files(name):
+    """Returns the database, export.xml and export.zip paths of a profile."""
+    directory = os.path.join(PROFILES_DIR, name)
+    return os.path.join(directory, 'health.db'), os.path.join(directory, 'export.xml'), os.path.join(directory, 'export.zip')
+
+def list_profiles():
+    """Returns the names of the profiles that have a database."""
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    return sorted(name for name in os.listdir(PROFILES_DIR)
+                  if PROFILE_NAME_RE.fullmatch(name) and os.path.exists(profile_files(name)[0]))
+
+def request_db():
+    """Returns the database the current request is for: its profile's shard, or DB_FILE."""
+    if has_request_context() and g.get('profile'):
+        return profile_files(g.profile)[0]
+    return DB_FILE
+
+def get_pool(path=None):
+    """Returns the connection pool (with its own query cache) of path, by default the request's database."""
+    path = path or request_db()
+    pool = pools.get(path)
+    if pool is None:
+        if has_request_context() and not os.path.exists(path):
+            abort(404)
+        pool = pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+def get_db():
+    """Returns the calling thread's read-only connection to the request's database."""
+    return get_pool().connection()
+
+def cached_query(query, *args):
+    """Returns query(conn, *args), served from the result cache when the data hasn't changed."""
+    pool = get_pool()
+    conn = pool.connection()
+    columnar = COLUMNAR_QUERIES.get(query.__name__)
+    if columnar is not None and pool.columns is not None and pool.columns.version == data_version(conn):
+        def compute():
+            result = columnar(pool.columns, *args)
+            return query(conn, *args) if result is None else result
+        return pool.cache.get(conn, (query.__name__,) + args, compute)
+    return pool.cache.get(conn, (query.__name__,) + args, lambda: query(conn, *args))
+
 try:
     from waitress import serve
 except ImportError:
     serve = None
 
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts the time jsonify() spends serializing towards the current request."""
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().response(*args, **kwargs)
+        if has_request_context():
+            g.json_seconds = g.get('json_seconds', 0) + time.perf_counter() - started
+        return response
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
+
+@app.url_value_preprocessor
+def select_profile(endpoint, values):
+    """Takes the <profile> out of /u/<profile>/... URLs; get_pool() then serves that profile's database."""
+    g.profile = values.pop('profile', None) if values else None
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+    metrics.inc('health_http_requests_in_flight')
+
+@app.before_request
+def check_profile():
+    if g.profile is not None and not (PROFILE_NAME_RE.fullmatch(g.profile) and os.path.isdir(os.path.join(PROFILES_DIR, g.profile))):
+        abort(404)
+
+@app.after_request
+def record_request(response):
+    """Records the request's metrics and, with --server-timing, reports db/json/total time to the browser.
+
+    Streamed bodies are produced after this runs, so their size and duration are recorded once
+    the server has sent them and closes the response.
+    """
+    total = time.perf_counter() - g.started
+    labels = (('endpoint', request.endpoint or 'none'),)
+    metrics.inc('health_http_requests_total', labels + (('status', str(response.status_code)),))
+    if 'json_seconds' in g:
+        metrics.observe('health_json_duration_seconds', labels, g.json_seconds)
+    if response.is_streamed:
+        sent, started = [0], g.started
+        response.response = count_bytes(response.response, sent)
+
+        def record_stream():
+            metrics.observe('health_http_request_duration_seconds', labels, time.perf_counter() - started)
+            metrics.inc('health_http_response_bytes_total', labels, sent[0])
+        response.call_on_close(record_stream)
+    else:
+        metrics.observe('health_http_request_duration_seconds', labels, total)
+        metrics.inc('health_http_response_bytes_total', labels, response.content_length or 0)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = (f"db;dur={g.get('db_seconds', 0) * 1000:.2f}, "
+                                             f"json;dur={g.get('json_seconds', 0) * 1000:.2f}, total;dur={total * 1000:.2f}")
+    return response
+
+def count_bytes(chunks, sent):
+    """Passes a streamed body through, adding up its size in sent[0]."""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        sent[0] += len(chunk)
+        yield chunk
+
+@app.after_request
+def compress_response(response):
+    """Compresses JSON responses with brotli or gzip, chunk by chunk for streamed ones."""
+    if (response.status_code != 200 or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers
+            or (not response.is_streamed and (response.content_length or 0) < COMPRESS_MIN_BYTES)):
+        return response
+    if brotli is not None and request.accept_encodings['br']:
+        encoding, compressor = 'br', brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    elif request.accept_encodings['gzip']:
+        encoding, compressor = 'gzip', zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compress, finish)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data()) + finish())
+    return response
+
+def compress_stream(chunks, compress, finish):
+    for chunk in chunks:
+        data = compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+@app.teardown_request
+def finish_request(error=None):
+    metrics.inc('health_http_requests_in_flight', amount=-1)
 
 @app.route('/')
+@app.route('/u/<profile>/')
 def dashboard():
-    """Serves the main dashboard HTML page."""
+    """Serves the main dashboard HTML page, or the list of profiles if there is no database at this URL."""
+    if not os.path.exists(request_db()):
+        links = ''.join(f'<li><a href="{request.script_root}/u/{name}/">{name}</a></li>' for name in list_profiles())
+        return Response(f'<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Health Dashboard</title></head>'
+                        f'<body><h1>Health Dashboard</h1><ul>{links}</ul></body></html>', status=200 if links else 404)
     html_template = """
     <!DOCTYPE html>
     <html lang="en">
@@ -208,6 +1976,7 @@ def dashboard():
 
         <script>
             const baseZoomOptions = { pan: { enabled: true, mode: 'x' }, zoom: { wheel: { enabled: true }, pinch: { enabled: true }, mode: 'x' } };
+            const chartPoints = (canvas) => Math.max(100, Math.round(canvas.clientWidth * (window.devicePixelRatio || 1)));
             // Chart creation functions (createChart, createSleepChart, createBloodPressureChart) go here...
             // These functions are the same as the previous version, just make sure they accept 'days' as an argument.
             
@@ -229,40 +1998,52 @@ def dashboard():
                 `;
             }
 
-            async function loadSummaryCards(days) {
-                try {
-                    const response = await fetch(`/api/summary?days=${days}`);
-                    if (!response.ok) return;
-                    const data = await response.json();
-                    
-                    document.getElementById('lowest-rhr-value').innerText = data.lowest_rhr ? `${Math.round(data.lowest_rhr)} bpm` : '-';
-                    document.getElementById('avg-steps-value').innerText = data.avg_steps ? Math.round(data.avg_steps).toLocaleString() : '-';
-                    document.getElementById('highest-hrv-value').innerText = data.highest_hrv ? `${Math.round(data.highest_hrv)} ms` : '-';
-                    
-                    if (data.avg_sleep_minutes) {
-                        const hours = Math.floor(data.avg_sleep_minutes / 60);
-                        const minutes = Math.round(data.avg_sleep_minutes % 60);
-                        document.getElementById('avg-sleep-value').innerText = `${hours}h ${minutes}m`;
-                    } else {
-                        document.getElementById('avg-sleep-value').innerText = '-';
-                    }
-                } catch (error) {
-                    console.error("Failed to load summary cards:", error);
+            function loadSummaryCards(data) {
+                document.getElementById('lowest-rhr-value').innerText = data.lowest_rhr ? `${Math.round(data.lowest_rhr)} bpm` : '-';
+                document.getElementById('avg-steps-value').innerText = data.avg_steps ? Math.round(data.avg_steps).toLocaleString() : '-';
+                document.getElementById('highest-hrv-value').innerText = data.highest_hrv ? `${Math.round(data.highest_hrv)} ms` : '-';
+                
+                if (data.avg_sleep_minutes) {
+                    const hours = Math.floor(data.avg_sleep_minutes / 60);
+                    const minutes = Math.round(data.avg_sleep_minutes % 60);
+                    document.getElementById('avg-sleep-value').innerText = `${hours}h ${minutes}m`;
+                } else {
+                    document.getElementById('avg-sleep-value').innerText = '-';
                 }
             }
 
-            function loadAllCharts(days) {
+            function showChartMessage(canvasId, message) {
+                const ctx = document.getElementById(canvasId).getContext('2d');
+                ctx.font = "16px Arial"; ctx.fillText(message, 10, 50);
+            }
+
+            async function loadDashboard(days) {
                 clearDashboard();
-                createSleepChart(days);
-                createBloodPressureChart(days);
-                createChart('respiratoryRateChart', `/api/data?type=HKQuantityTypeIdentifierRespiratoryRate&days=${days}`, { label: 'Respiratory Rate', borderColor: 'rgb(4, 186, 179)', backgroundColor: 'rgba(4, 186, 179, 0.5)', yAxisLabel: 'breaths/min' });
-                createChart('bodyTempChart', `/api/data?type=HKQuantityTypeIdentifierBodyTemperature&days=${days}`, { label: 'Body Temperature', borderColor: 'rgb(255, 128, 0)', backgroundColor: 'rgba(255, 128, 0, 0.5)', yAxisLabel: '°C' });
-                createChart('restingEnergyChart', `/api/data?type=HKQuantityTypeIdentifierBasalEnergyBurned&days=${days}&aggregate=sum`, { label: 'Resting Energy Burned', borderColor: 'rgb(75, 192, 192)', backgroundColor: 'rgba(75, 192, 192, 0.5)', yAxisLabel: 'kcal' });
-                createChart('bloodOxygenChart', `/api/data?type=HKQuantityTypeIdentifierOxygenSaturation&days=${days}`, { label: 'Blood Oxygen (SpO2)', borderColor: 'rgb(255, 26, 104)', backgroundColor: 'rgba(255, 26, 104, 0.5)', yAxisLabel: '%', transform: (y) => y * 100 });
-                createChart('restingHeartRateChart', `/api/data?type=HKQuantityTypeIdentifierRestingHeartRate&days=${days}`, { label: 'Resting Heart Rate', borderColor: 'rgb(255, 99, 132)', backgroundColor: 'rgba(255, 99, 132, 0.5)', yAxisLabel: 'bpm' });
-                createChart('stepsChart', `/api/data?type=HKQuantityTypeIdentifierStepCount&days=${days}&aggregate=sum`, { label: 'Daily Steps', borderColor: 'rgb(54, 162, 235)', backgroundColor: 'rgba(54, 162, 235, 0.5)', yAxisLabel: 'Count' });
-                createChart('activeEnergyChart', `/api/data?type=HKQuantityTypeIdentifierActiveEnergyBurned&days=${days}&aggregate=sum`, { label: 'Active Energy Burned', borderColor: 'rgb(255, 159, 64)', backgroundColor: 'rgba(255, 159, 64, 0.5)', yAxisLabel: 'kcal' });
-                createChart('hrvChart', `/api/data?type=HKQuantityTypeIdentifierHeartRateVariabilitySDNN&days=${days}`, { label: 'Heart Rate Variability (SDNN)', borderColor: 'rgb(153, 102, 255)', backgroundColor: 'rgba(153, 102, 255, 0.5)', yAxisLabel: 'ms' });
+                let dashboard;
+                try {
+                    // All charts and summary cards come from one request. It is revalidated with
+                    // its ETag, so re-rendering unchanged data costs a 304 instead of new queries.
+                    const points = chartPoints(document.getElementById('restingHeartRateChart'));
+                    const response = await fetch(`api/dashboard?days=${days}&points=${points}`);
+                    if (!response.ok) throw new Error('Network error for dashboard data');
+                    dashboard = await response.json();
+                } catch (error) {
+                    console.error('Failed to load dashboard data:', error);
+                    document.querySelectorAll('.dashboard-grid canvas').forEach(canvas => showChartMessage(canvas.id, `Could not load chart: ${error.message}`));
+                    return;
+                }
+                const series = dashboard.series;
+                loadSummaryCards(dashboard.summary);
+                createSleepChart(dashboard.sleep);
+                createBloodPressureChart(series.bloodPressureSystolic, series.bloodPressureDiastolic);
+                createChart('respiratoryRateChart', series.respiratoryRate, { label: 'Respiratory Rate', borderColor: 'rgb(4, 186, 179)', backgroundColor: 'rgba(4, 186, 179, 0.5)', yAxisLabel: 'breaths/min' });
+                createChart('bodyTempChart', series.bodyTemp, { label: 'Body Temperature', borderColor: 'rgb(255, 128, 0)', backgroundColor: 'rgba(255, 128, 0, 0.5)', yAxisLabel: '°C' });
+                createChart('restingEnergyChart', series.restingEnergy, { label: 'Resting Energy Burned', borderColor: 'rgb(75, 192, 192)', backgroundColor: 'rgba(75, 192, 192, 0.5)', yAxisLabel: 'kcal' });
+                createChart('bloodOxygenChart', series.bloodOxygen, { label: 'Blood Oxygen (SpO2)', borderColor: 'rgb(255, 26, 104)', backgroundColor: 'rgba(255, 26, 104, 0.5)', yAxisLabel: '%', transform: (y) => y * 100 });
+                createChart('restingHeartRateChart', series.restingHeartRate, { label: 'Resting Heart Rate', borderColor: 'rgb(255, 99, 132)', backgroundColor: 'rgba(255, 99, 132, 0.5)', yAxisLabel: 'bpm' });
+                createChart('stepsChart', series.steps, { label: 'Daily Steps', borderColor: 'rgb(54, 162, 235)', backgroundColor: 'rgba(54, 162, 235, 0.5)', yAxisLabel: 'Count' });
+                createChart('activeEnergyChart', series.activeEnergy, { label: 'Active Energy Burned', borderColor: 'rgb(255, 159, 64)', backgroundColor: 'rgba(255, 159, 64, 0.5)', yAxisLabel: 'kcal' });
+                createChart('hrvChart', series.hrv, { label: 'Heart Rate Variability (SDNN)', borderColor: 'rgb(153, 102, 255)', backgroundColor: 'rgba(153, 102, 255, 0.5)', yAxisLabel: 'ms' });
             }
             
             function applyTheme(isDark) {
@@ -279,13 +2060,10 @@ def dashboard():
             
             // This function combines all the chart creation logic. It's long but self-contained.
             function initializeChartFunctions() {
-                // This is the createChart function from the previous version, now takes 'days'
-                window.createChart = async function(canvasId, apiEndpoint, chartConfig) {
+                // Renders a line chart from /api/data style rows
+                window.createChart = function(canvasId, apiData, chartConfig) {
                     const ctx = document.getElementById(canvasId).getContext('2d');
                     try {
-                        const response = await fetch(apiEndpoint);
-                        if (!response.ok) throw new Error(`Network error for ${chartConfig.label}`);
-                        const apiData = await response.json();
                         if (apiData.length === 0) { ctx.font = "16px Arial"; ctx.fillText(`No data available for ${chartConfig.label}`, 10, 50); return; }
                         const transform = chartConfig.transform || (y => y);
                         const chartData = { datasets: [{ label: chartConfig.label, data: apiData.map(d => ({ x: d.start_date, y: transform(d.record_value) })), borderColor: chartConfig.borderColor, backgroundColor: chartConfig.backgroundColor, borderWidth: 2, pointRadius: 1.5, tension: 0.1 }] };
@@ -295,13 +2073,10 @@ def dashboard():
                     } catch (error) { console.error(`Failed to load data for ${chartConfig.label}:`, error); ctx.font = "16px Arial"; ctx.fillText(`Could not load chart: ${error.message}`, 10, 50); }
                 };
                 
-                // This is the createSleepChart function, now takes 'days'
-                window.createSleepChart = async function(days) {
+                // Renders the stacked sleep stage chart from /api/sleep style data
+                window.createSleepChart = function(sleepData) {
                     const ctx = document.getElementById('sleepChart').getContext('2d');
                     try {
-                        const response = await fetch(`/api/sleep?days=${days}`);
-                        if (!response.ok) throw new Error('Network error for Sleep Data');
-                        const sleepData = await response.json();
                         if (sleepData.labels.length === 0) { ctx.font = "16px Arial"; ctx.fillText(`No data available for Sleep`, 10, 50); return; }
                         const stageConfig = { 'HKCategoryValueSleepAnalysisAwake': { label: 'Awake', backgroundColor: 'rgba(255, 99, 132, 0.7)' }, 'HKCategoryValueSleepAnalysisAsleepREM': { label: 'REM', backgroundColor: 'rgba(54, 162, 235, 0.7)' }, 'HKCategoryValueSleepAnalysisAsleepCore': { label: 'Core', backgroundColor: 'rgba(75, 192, 192, 0.7)' }, 'HKCategoryValueSleepAnalysisAsleepDeep': { label: 'Deep', backgroundColor: 'rgba(153, 102, 255, 0.7)' } };
                         const datasets = Object.keys(stageConfig).map(stageKey => ({ label: stageConfig[stageKey].label, backgroundColor: stageConfig[stageKey].backgroundColor, data: sleepData.labels.map(date => sleepData.stages[stageKey][date] || 0) }));
@@ -311,14 +2086,10 @@ def dashboard():
                     } catch (error) { console.error('Failed to load data for Sleep Chart:', error); ctx.font = "16px Arial"; ctx.fillText(`Could not load chart: ${error.message}`, 10, 50); }
                 };
 
-                // This is the createBloodPressureChart function, now takes 'days'
-                window.createBloodPressureChart = async function(days) {
+                // Renders systolic and diastolic readings in one chart
+                window.createBloodPressureChart = function(systolicData, diastolicData) {
                     const ctx = document.getElementById('bloodPressureChart').getContext('2d');
                     try {
-                        const [systolicResponse, diastolicResponse] = await Promise.all([ fetch(`/api/data?type=HKQuantityTypeIdentifierBloodPressureSystolic&days=${days}`), fetch(`/api/data?type=HKQuantityTypeIdentifierBloodPressureDiastolic&days=${days}`) ]);
-                        if (!systolicResponse.ok || !diastolicResponse.ok) throw new Error('Network error for Blood Pressure');
-                        const systolicData = await systolicResponse.json();
-                        const diastolicData = await diastolicResponse.json();
                         if (systolicData.length === 0 && diastolicData.length === 0) { ctx.font = "16px Arial"; ctx.fillText(`No data available for Blood Pressure`, 10, 50); return; }
                         const chartData = { datasets: [ { label: 'Systolic', data: systolicData.map(d => ({x: d.start_date, y: d.record_value})), borderColor: 'rgb(255, 99, 132)', backgroundColor: 'rgba(255, 99, 132, 0.5)', borderWidth: 2, pointRadius: 2.5, tension: 0.1 }, { label: 'Diastolic', data: diastolicData.map(d => ({x: d.start_date, y: d.record_value})), borderColor: 'rgb(54, 162, 235)', backgroundColor: 'rgba(54, 162, 235, 0.5)', borderWidth: 2, pointRadius: 2.5, tension: 0.1 } ] };
                         const allDates = [ ...systolicData.map(d => new Date(d.start_date)), ...diastolicData.map(d => new Date(d.start_date)) ];
@@ -336,11 +2107,6 @@ def dashboard():
                 const darkModeCheckbox = document.getElementById('dark-mode-checkbox');
                 let currentDays = document.querySelector('.date-btn.active').dataset.days;
 
-                function loadDashboard(days) {
-                    loadSummaryCards(days);
-                    loadAllCharts(days);
-                }
-
                 // Dark Mode Logic
                 const prefersDark = window.matchMedia('(prefers-color-scheme: dark)').matches;
                 const savedTheme = localStorage.getItem('theme');
@@ -374,118 +2140,717 @@ def dashboard():
     """
     return Response(html_template)
 
+# Series shown on the dashboard: key -> (record type, daily aggregate or None for raw samples).
+DASHBOARD_SERIES = {
+    'respiratoryRate': ('HKQuantityTypeIdentifierRespiratoryRate', None),
+    'bodyTemp': ('HKQuantityTypeIdentifierBodyTemperature', None),
+    'restingEnergy': ('HKQuantityTypeIdentifierBasalEnergyBurned', 'sum'),
+    'bloodOxygen': ('HKQuantityTypeIdentifierOxygenSaturation', None),
+    'restingHeartRate': ('HKQuantityTypeIdentifierRestingHeartRate', None),
+    'steps': ('HKQuantityTypeIdentifierStepCount', 'sum'),
+    'activeEnergy': ('HKQuantityTypeIdentifierActiveEnergyBurned', 'sum'),
+    'hrv': ('HKQuantityTypeIdentifierHeartRateVariabilitySDNN', None),
+    'bloodPressureSystolic': ('HKQuantityTypeIdentifierBloodPressureSystolic', None),
+    'bloodPressureDiastolic': ('HKQuantityTypeIdentifierBloodPressureDiastolic', None),
+}
+
+def data_version(conn):
+    """Returns the counter the importer bumps on every commit, for ETags."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def window_start(days):
+    """Returns the first day of a 'last N days' window, so all requests on one day share it."""
+    return day_number(datetime.now(home_zone()) - timedelta(days=days))
+
+def series_tiers(conn, data_type, start_day):
+    """Returns the (raw, minute) cut-offs of compact_storage() if a series from start_day on reaches into the compacted tiers, else None."""
+    tiers = storage_tiers(conn) if data_type in TIERED_TYPES else None
+    if tiers is None or day_start_ts(start_day) >= tiers['raw_cutoff']:
+        return None
+    return tiers['raw_cutoff'], tiers['minute_cutoff']
+
+def series_query(data_type, start_day, aggregate=None, period='day', tiers=None):
+    """Returns the SQL and parameters for a series; each row is (x, value, label) with x in epoch seconds.
+
+    Weekly and monthly rows are (period key, sum, count) instead, for period_totals(). With
+    the cut-offs from series_tiers(), raw series continue into the per-bucket means of the
+    compacted tiers before them.
+    """
+    # Daily aggregates come from the pre-computed daily_rollup table.
+    if aggregate and period != 'day':
+        # Rows come in day order from the primary key; period_totals() adds them up without a temp B-tree.
+        query = f"""SELECT {period}, sum_value, sample_count FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = ?) AND day >= ? ORDER BY day;"""
+        params = [data_type, start_day]
+    elif aggregate == 'sum':
+        query = """SELECT day * 86400, sum_value, date(day * 86400, 'unixepoch') FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = ?) AND day >= ? ORDER BY day;"""
+        params = [data_type, start_day]
+    elif aggregate == 'avg':
+        query = """SELECT day * 86400, avg_value, date(day * 86400, 'unixepoch') FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = ?) AND day >= ? ORDER BY day;"""
+        params = [data_type, start_day]
+    else:
+        query = """SELECT ts, value, strftime('%Y-%m-%dT%H:%M:%SZ', ts, 'unixepoch') FROM samples WHERE type_id = (SELECT id FROM record_types WHERE name = ?) AND ts >= ? ORDER BY ts;"""
+        params = [data_type, day_start_ts(start_day)]
+        if tiers is not None:
+            raw_cutoff, minute_cutoff = tiers
+            start = params[1]
+            arms, params = [], []
+            for table, low, high in (('samples_5m', start, minute_cutoff), ('samples_1m', max(start, minute_cutoff), raw_cutoff)):
+                if low < high:
+                    arms.append(f"SELECT ts, sum_value / sample_count, strftime('%Y-%m-%dT%H:%M:%SZ', ts, 'unixepoch') FROM {table} WHERE type_id = (SELECT id FROM record_types WHERE name = ?) AND ts >= ? AND ts < ?")
+                    params += [data_type, low, high]
+            # Each arm comes back in ts order from its primary key, so ORDER BY merges them without sorting.
+            arms.append(query[:-len(' ORDER BY ts;')])
+            query = ' UNION ALL '.join(arms) + ' ORDER BY 1;'
+            params += [data_type, raw_cutoff]
+    return query, params
+
+def query_series(conn, data_type, start_day, aggregate=None, points=None, resolution=None, mode='lttb', period='day', tiers=None):
+    cursor = conn.cursor()
+    cursor.execute(*series_query(data_type, start_day, aggregate, period, tiers))
+    series = cursor.fetchall()
+    if aggregate and period != 'day':
+        series = period_totals(series, period, aggregate)
+    if points or resolution:
+        series = downsample(series, points, resolution, mode)
+    return [{'start_date': label, 'record_value': value} for x, value, label in series]
+
+def stream_series(conn, data_type, start_day, columnar=False, tiers=None):
+    """Returns a generator of a raw series as JSON text, encoding STREAM_CHUNK_ROWS rows at a time as they come off the cursor.
+
+    The rows format matches jsonify(query_series(...)); columnar is {"t": [labels], "v": [values]}.
+    The query runs right away, while the request is handled, so its time counts towards it.
+    """
+    cursor = conn.cursor()
+    cursor.execute(*series_query(data_type, start_day, tiers=tiers))
+    return encode_series(iter(lambda: cursor.fetchmany(STREAM_CHUNK_ROWS), []), columnar)
+
+def encode_series(chunks, columnar):
+    separator = ''
+    if not columnar:
+        yield '['
+        for rows in chunks:
+            yield separator + json.dumps([{'record_value': value, 'start_date': label} for _, value, label in rows], separators=(',', ':'))[1:-1]
+            separator = ','
+        yield ']\n'
+        return
+    # Labels go out as they are read; only the values (8 bytes each) wait for the second array.
+    values = array('d')
+    yield '{"t":['
+    for rows in chunks:
+        yield separator + json.dumps([label for _, _, label in rows], separators=(',', ':'))[1:-1]
+        values.extend(value for _, value, _ in rows)
+        separator = ','
+    yield '],"v":['
+    for start in range(0, len(values), STREAM_CHUNK_ROWS):
+        yield (',' if start else '') + json.dumps(values[start:start + STREAM_CHUNK_ROWS].tolist(), separators=(',', ':'))[1:-1]
+    yield ']}\n'
+
+def query_sleep(conn, start_day):
+    """Returns the nightly stage minutes, bedtimes and wake times from sleep_nights, keyed by the date of waking up."""
+    query = """
+        SELECT date(night * 86400, 'unixepoch'), awake_minutes, rem_minutes, core_minutes, deep_minutes,
+               strftime('%H:%M', bedtime + tz_offset * 60, 'unixepoch'), strftime('%H:%M', wake_time + tz_offset * 60, 'unixepoch')
+        FROM sleep_nights WHERE night >= ? ORDER BY night;"""
+    cursor = conn.cursor()
+    cursor.execute(query, [start_day])
+    sleep_stages = {
+        'HKCategoryValueSleepAnalysisAwake': {}, 'HKCategoryValueSleepAnalysisAsleepREM': {},
+        'HKCategoryValueSleepAnalysisAsleepCore': {}, 'HKCategoryValueSleepAnalysisAsleepDeep': {},
+    }
+    labels, bedtimes, wake_times = [], {}, {}
+    for date, *minutes, bedtime, wake_time in cursor.fetchall():
+        for stage, total_minutes in zip(sleep_stages, minutes):
+            if total_minutes:
+                sleep_stages[stage][date] = total_minutes
+        labels.append(date)
+        bedtimes[date], wake_times[date] = bedtime, wake_time
+    return {'labels': labels, 'stages': sleep_stages, 'bedtime': bedtimes, 'wake_time': wake_times}
+
+def query_summary(conn, start_day):
+    summary = {}
+    cursor = conn.cursor()
+
+    # Lowest Resting HR
+    cursor.execute("SELECT MIN(min_value) FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = 'HKQuantityTypeIdentifierRestingHeartRate') AND day >= ?", [start_day])
+    summary['lowest_rhr'] = cursor.fetchone()[0]
+
+    # Average Daily Steps
+    cursor.execute("SELECT AVG(sum_value) FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = 'HKQuantityTypeIdentifierStepCount') AND day >= ?", [start_day])
+    summary['avg_steps'] = cursor.fetchone()[0]
+
+    # Highest HRV
+    cursor.execute("SELECT MAX(max_value) FROM daily_rollup WHERE type_id = (SELECT id FROM record_types WHERE name = 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN') AND day >= ?", [start_day])
+    summary['highest_hrv'] = cursor.fetchone()[0]
+
+    # Average Sleep
+    cursor.execute("SELECT AVG(asleep_minutes) FROM sleep_nights WHERE night >= ? AND asleep_minutes > 0", [start_day])
+    summary['avg_sleep_minutes'] = cursor.fetchone()[0]
+    return summary
+
 @app.route('/api/data')
+@app.route('/u/<profile>/api/data')
 def get_data():
     data_type = request.args.get('type')
     days = int(request.args.get('days', 30))
     aggregate = request.args.get('aggregate')
+    if aggregate not in ('sum', 'avg'):
+        aggregate = None
+    period = request.args.get('period', 'day') if aggregate else 'day'
     if not data_type: return jsonify({"error": "Missing 'type' parameter"}), 400
-    start_date = datetime.now() - timedelta(days=days)
-    params = [data_type, start_date]
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        if aggregate == 'sum':
-            query = """SELECT date(start_date) as start_date, SUM(record_value) as record_value FROM health_data WHERE record_type = ? AND start_date >= ? GROUP BY date(start_date) ORDER BY start_date;"""
-        elif aggregate == 'avg':
-            query = """SELECT date(start_date) as start_date, AVG(record_value) as record_value FROM health_data WHERE record_type = ? AND start_date >= ? GROUP BY date(start_date) ORDER BY start_date;"""
-        else:
-            query = """SELECT start_date, record_value FROM health_data WHERE record_type = ? AND start_date >= ? ORDER BY start_date;"""
-        cursor.execute(query, params)
-        data = [dict(row) for row in cursor.fetchall()]
-        return jsonify(data)
+    if period not in ('day', 'week', 'month'):
+        return jsonify({"error": "Invalid 'period' parameter, use day, week or month"}), 400
+    try:
+        points = int(request.args['points']) if 'points' in request.args else None
+        resolution = parse_resolution(request.args['resolution']) if 'resolution' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'points' or 'resolution' parameter (resolution must be at least 1s)"}), 400
+    mode = request.args.get('mode', 'mean' if resolution else 'lttb')
+    if (points is not None and points < 3) or mode not in ('lttb', 'minmax', 'mean') or (resolution and mode == 'lttb'):
+        return jsonify({"error": "Use points >= 3 with mode lttb|minmax|mean, or resolution with mode minmax|mean"}), 400
+    columnar = request.args.get('format') == 'columnar'
+    start_day = window_start(days)
+    tiers = None if aggregate else series_tiers(get_db(), data_type, start_day)
+    if not (points or resolution):
+        if aggregate is None:
+            # Full-resolution raw series can be huge: stream them instead of building and caching them.
+            return Response(stream_series(get_db(), data_type, start_day, columnar, tiers), mimetype='application/json')
+        mode = None
+    series = cached_query(query_series, data_type, start_day, aggregate, points, resolution, mode, period, tiers)
+    if columnar:
+        return jsonify({'t': [row['start_date'] for row in series], 'v': [row['record_value'] for row in series]})
+    return jsonify(series)
 
 @app.route('/api/sleep')
+@app.route('/u/<profile>/api/sleep')
 def get_sleep_data():
     days = int(request.args.get('days', 30))
-    start_date = datetime.now() - timedelta(days=days)
-    query = """
-        SELECT date(start_date) as sleep_date, record_type, SUM(record_value) as total_minutes
-        FROM health_data WHERE record_type IN (
-            'HKCategoryValueSleepAnalysisAsleepDeep', 'HKCategoryValueSleepAnalysisAsleepCore',
-            'HKCategoryValueSleepAnalysisAsleepREM', 'HKCategoryValueSleepAnalysisAwake'
-        ) AND start_date >= ? GROUP BY sleep_date, record_type ORDER BY sleep_date;"""
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(query, [start_date])
-        sleep_stages = {
-            'HKCategoryValueSleepAnalysisAwake': {}, 'HKCategoryValueSleepAnalysisAsleepREM': {},
-            'HKCategoryValueSleepAnalysisAsleepCore': {}, 'HKCategoryValueSleepAnalysisAsleepDeep': {},
-        }
-        dates = set()
-        for row in cursor.fetchall():
-            row_dict = dict(row)
-            date, record_type, total_minutes = row_dict['sleep_date'], row_dict['record_type'], row_dict['total_minutes']
-            if record_type in sleep_stages:
-                sleep_stages[record_type][date] = total_minutes
-                dates.add(date)
-        sorted_dates = sorted(list(dates))
-        return jsonify({'labels': sorted_dates, 'stages': sleep_stages})
+    return jsonify(cached_query(query_sleep, window_start(days)))
 
 # --- NEW: API Endpoint for Summary Cards ---
 @app.route('/api/summary')
+@app.route('/u/<profile>/api/summary')
 def get_summary_data():
     days = int(request.args.get('days', 90))
-    start_date = datetime.now() - timedelta(days=days)
-    
-    summary = {}
-    
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-
-        # Lowest Resting HR
-        cursor.execute("SELECT MIN(record_value) FROM health_data WHERE record_type = 'HKQuantityTypeIdentifierRestingHeartRate' AND start_date >= ?", [start_date])
-        summary['lowest_rhr'] = cursor.fetchone()[0]
-
-        # Average Daily Steps
-        cursor.execute("""
-            SELECT AVG(daily_total) FROM (
-                SELECT SUM(record_value) as daily_total 
-                FROM health_data 
-                WHERE record_type = 'HKQuantityTypeIdentifierStepCount' AND start_date >= ? 
-                GROUP BY date(start_date)
-            )
-        """, [start_date])
-        summary['avg_steps'] = cursor.fetchone()[0]
-
-        # Highest HRV
-        cursor.execute("SELECT MAX(record_value) FROM health_data WHERE record_type = 'HKQuantityTypeIdentifierHeartRateVariabilitySDNN' AND start_date >= ?", [start_date])
-        summary['highest_hrv'] = cursor.fetchone()[0]
-        
-        # Average Sleep
-        sleep_types = ['HKCategoryValueSleepAnalysisAsleepDeep', 'HKCategoryValueSleepAnalysisAsleepCore', 'HKCategoryValueSleepAnalysisAsleepREM']
-        placeholders = ','.join('?' for _ in sleep_types)
-        cursor.execute(f"""
-            SELECT AVG(daily_total) FROM (
-                SELECT SUM(record_value) as daily_total 
-                FROM health_data 
-                WHERE record_type IN ({placeholders}) AND start_date >= ? 
-                GROUP BY date(start_date)
-            )
-        """, sleep_types + [start_date])
-        summary['avg_sleep_minutes'] = cursor.fetchone()[0]
-
-    return jsonify(summary)
+    return jsonify(cached_query(query_summary, window_start(days)))
+
+@app.route('/api/dashboard')
+@app.route('/u/<profile>/api/dashboard')
+def get_dashboard_data():
+    """Returns every dashboard series, the sleep chart and the summary cards in one response.
+
+    The ETag changes whenever an import commits new data (or the day changes), so a
+    browser re-rendering the same range, e.g. after a theme toggle, gets a 304.
+    """
+    days = int(request.args.get('days', 30))
+    try:
+        points = int(request.args['points']) if 'points' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'points' parameter"}), 400
+    if points is not None and points < 3:
+        return jsonify({"error": "Use points >= 3"}), 400
+    start_day = window_start(days)
+    etag = f"{data_version(get_db())}-{start_day}-{points}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        series = {}
+        for key, (data_type, aggregate) in DASHBOARD_SERIES.items():
+            raw_points = None if aggregate else points
+            tiers = None if aggregate else series_tiers(get_db(), data_type, start_day)
+            series[key] = cached_query(query_series, data_type, start_day, aggregate, raw_points, None, 'lttb' if raw_points else None, 'day', tiers)
+        response = jsonify({
+            'series': series,
+            'sleep': cached_query(query_sleep, start_day),
+            'summary': cached_query(query_summary, start_day),
+        })
+    # Weak, because the gzip and brotli encodings of the body differ byte for byte.
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus text exposition of the request, query, cache and import metrics."""
+    for path, pool in list(pools.items()):
+        stats = pool.cache.stats()
+        labels = (('db', path),)
+        metrics.set('health_query_cache_hits_total', labels, stats['hits'])
+        metrics.set('health_query_cache_misses_total', labels, stats['misses'])
+        metrics.set('health_query_cache_entries', labels, stats['entries'])
+        row = pool.connection().execute("SELECT value FROM meta WHERE key = 'import_phase_seconds'").fetchone()
+        for phase, seconds in (json.loads(row[0]) if row else {}).items():
+            metrics.set('health_import_phase_seconds', labels + (('phase', phase),), seconds)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/cache')
+@app.route('/u/<profile>/api/cache')
+def get_cache_stats():
+    """Reports query cache hits and misses."""
+    return jsonify(get_pool().cache.stats())
+
+ALLOW_IMPORT = False  # 'serve --allow-import' enables /api/import
+IMPORT_LOG = 'import.log'
+IMPORT_LOG_LINES = 5
+imports = {}  # profile ('' for the default database) -> import process started by /api/import
+imports_lock = threading.Lock()
+
+@app.route('/api/import', methods=['GET', 'POST'])
+@app.route('/u/<profile>/api/import', methods=['GET', 'POST'])
+def run_import():
+    """POST imports the profile's export.xml or export.zip in a background process; GET reports its progress.
+
+    The import writes only this profile's database, so the others are served as before and
+    this one keeps serving the committed data (WAL) until its caches see the new data version.
+    Only available with 'serve --allow-import'; the server has no authentication.
+    """
+    if not ALLOW_IMPORT:
+        abort(404)
+    # Browsers send an Origin with cross-site form posts; only the dashboard's own pages may start imports.
+    origin = request.headers.get('Origin')
+    if request.method == 'POST' and origin is not None and urlsplit(origin).netloc != request.host:
+        return jsonify({"error": "Cross-origin import requests are not allowed"}), 403
+    # On / this is the database DB_FILE names, which 'serve --profile NAME' points at that profile.
+    profile = g.profile or PROFILE or ''
+    directory = os.path.join(PROFILES_DIR, profile) if profile else '.'
+    log_path = os.path.join(directory, IMPORT_LOG)
+    started = False
+    with imports_lock:
+        process = imports.get(profile)
+        if request.method == 'POST':
+            if process is not None and process.poll() is None:
+                return jsonify({"error": "An import of this profile is already running"}), 409
+            command = [sys.executable, '-u', os.path.abspath(__file__), 'import'] + (['--profile', profile] if profile else [])
+            with open(log_path, 'w') as log:
+                process = imports[profile] = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            started = True
+    if process is None:
+        return jsonify({'running': False, 'exit_code': None, 'log': []})
+    try:
+        with open(log_path, 'rb') as log:
+            log.seek(max(0, os.fstat(log.fileno()).st_size - 4096))
+            lines = log.read().decode(errors='replace').splitlines()
+    except OSError:
+        lines = []
+    return jsonify({'running': process.poll() is None, 'exit_code': process.poll(),
+                    'log': [line for line in lines if line.strip()][-IMPORT_LOG_LINES:]}), 202 if started else 200
+
+def plan_problems(plan):
+    """Returns the query plan steps that read a whole table or sort into a temp B-tree."""
+    return [detail for detail in plan
+            if (detail.startswith('SCAN ') and not detail.startswith('SCAN (') and detail != 'SCAN CONSTANT ROW')
+            or 'TEMP B-TREE' in detail]
+
+def explain_queries(days=30):
+    """Runs every API route once, prints the plan of each SQL statement issued and flags full scans and temp B-trees.
+
+    Returns the number of flagged statements.
+    """
+    conn = get_db()
+    statements = {}
+    # Trace callbacks see the statements with their parameters filled in; literals are
+    # masked so each statement shape is explained once.
+    def trace(sql):
+        shape = re.sub(r"'[^']*'|\b\d+\b", '?', ' '.join(sql.split()))
+        statements.setdefault(shape, sql)
+    conn.set_trace_callback(trace)
+    client = app.test_client()
+    urls = [f'/api/sleep?days={days}', f'/api/summary?days={days}', f'/api/dashboard?days={days}&points=500']
+    for data_type, aggregate in DASHBOARD_SERIES.values():
+        urls.append(f'/api/data?type={data_type}&days={days}&points=500')
+        urls.extend(f'/api/data?type={data_type}&days={days}&aggregate={kind}' for kind in ('sum', 'avg'))
+        urls.extend(f'/api/data?type={data_type}&days={days}&aggregate=sum&period={period}' for period in ('week', 'month'))
+    tiers = storage_tiers(conn)
+    if tiers is not None:
+        # Windows reaching past the raw samples into the minute and 5-minute tiers.
+        for cutoff in (tiers['raw_cutoff'], tiers['minute_cutoff']):
+            urls.append(f'/api/data?type=HKQuantityTypeIdentifierHeartRate&days={window_start(0) - cutoff // 86400 + 2}&points=500')
+    for url in urls:
+        client.get(url)
+    conn.set_trace_callback(None)
+
+    flagged = 0
+    for shape, sql in statements.items():
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        problems = plan_problems(plan)
+        flagged += bool(problems)
+        print(('[!] ' if problems else '[ok] ') + (shape if len(shape) <= 150 else shape[:147] + '...'))
+        for detail in plan:
+            print(f"      {detail}{'   <-- ' if detail in problems else ''}")
+    print(f"{len(statements)} statements explained, {flagged} with full scans or temp B-trees.")
+    return flagged
+
+# --- BENCHMARK ---
+# 'bench' generates a synthetic export.xml of a chosen size, imports it into a scratch
+# database and load-tests the API, printing the results as JSON for run-to-run comparison.
+SLEEP_STAGES = ('HKCategoryValueSleepAnalysisAsleepCore', 'HKCategoryValueSleepAnalysisAsleepDeep',
+                'HKCategoryValueSleepAnalysisAsleepREM', 'HKCategoryValueSleepAnalysisAwake')
+SYNTHETIC_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE HealthData [
+<!ELEMENT HealthData (ExportDate,Me,(Record|Correlation|Workout|ActivitySummary|ClinicalRecord)*)>
+<!ATTLIST HealthData
+  locale CDATA #REQUIRED
+>
+]>
+<HealthData locale="en_US">
+ <ExportDate value="{date} 08:00:00 {offset}"/>
+ <Me HKCharacteristicTypeIdentifierDateOfBirth="1985-04-12" HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexNotSet"/>
+'''
+BENCH_ENDPOINTS = {
+    'page': '/',
+    'data_raw': '/api/data?type=HKQuantityTypeIdentifierHeartRate&days={days}&points=1000',
+    'data_daily': '/api/data?type=HKQuantityTypeIdentifierStepCount&days={days}&aggregate=sum',
+    'sleep': '/api/sleep?days={days}',
+    'summary': '/api/summary?days={days}',
+    'dashboard': '/api/dashboard?days={days}&points=1000',
+}
+BENCH_DAYS = (7, 30, 90, 365)
+
+def synthetic_day(rng, day, offset):
+    """Returns the export elements for one local day (days since 1970-01-01) as a string.
+
+    The mix follows a typical watch and phone export: heart rate every few minutes, steps,
+    distance and energy while awake, a night of sleep stages with respiratory rate and SpO2,
+    daily resting values, and occasional workouts and blood pressure readings.
+    """
+    date = (EPOCH + timedelta(days=day)).strftime('%Y-%m-%d')
+    next_date = (EPOCH + timedelta(days=day + 1)).strftime('%Y-%m-%d')
+    def stamp(seconds):
+        prefix = date if seconds < 86400 else next_date
+        seconds %= 86400
+        return f'{prefix} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d} {offset}'
+    def record(record_type, source, unit, start, end, value, extra=''):
+        unit = f' unit="{unit}"' if unit else ''
+        attributes = f'type="{record_type}" sourceName="{source}" sourceVersion="10.1"{unit} creationDate="{stamp(end + 60)}" startDate="{stamp(start)}" endDate="{stamp(end)}" value="{value}"'
+        if extra:
+            return f' <Record {attributes}>\n{extra} </Record>\n'
+        return f' <Record {attributes}/>\n'
+    out = []
+    t = rng.randint(0, 300)
+    while t < 86400:
+        awake = 25200 <= t < 82800
+        bpm = rng.randint(62, 105) if awake else rng.randint(48, 62)
+        out.append(record('HKQuantityTypeIdentifierHeartRate', 'Apple Watch', 'count/min', t, t, bpm,
+                          f'  <MetadataEntry key="HKMetadataKeyHeartRateMotionContext" value="{1 if awake else 0}"/>\n'))
+        t += rng.randint(180, 480)
+    for source in ('iPhone', 'Apple Watch'):
+        t = 25200 + rng.randint(0, 1800)
+        while t < 82800:
+            length = rng.randint(60, 600)
+            steps = rng.randint(10, 900)
+            out.append(record('HKQuantityTypeIdentifierStepCount', source, 'count', t, t + length, steps))
+            out.append(record('HKQuantityTypeIdentifierDistanceWalkingRunning', source, 'km', t, t + length, round(steps * 0.00075, 5)))
+            t += length + rng.randint(300, 2400)
+    t = 25200 + rng.randint(0, 120)
+    while t < 82800:
+        out.append(record('HKQuantityTypeIdentifierActiveEnergyBurned', 'Apple Watch', 'kcal', t, t + 60, round(rng.uniform(0.05, 6), 3)))
+        t += rng.randint(120, 180)
+    for t in range(rng.randint(0, 60), 86400, 900):
+        out.append(record('HKQuantityTypeIdentifierBasalEnergyBurned', 'Apple Watch', 'kcal', t, t + 900, round(rng.uniform(14, 19), 3)))
+    t = 3600 + rng.randint(0, 3600)
+    while t < 23400:
+        out.append(record('HKQuantityTypeIdentifierRespiratoryRate', 'Apple Watch', 'count/min', t, t + 60, round(rng.uniform(12, 18), 1)))
+        if rng.random() < 0.3:
+            out.append(record('HKQuantityTypeIdentifierOxygenSaturation', 'Apple Watch', '%', t, t, round(rng.uniform(0.93, 1), 2)))
+        t += rng.randint(600, 1200)
+    for _ in range(rng.randint(2, 6)):
+        t = rng.randint(0, 86000)
+        out.append(record('HKQuantityTypeIdentifierHeartRateVariabilitySDNN', 'Apple Watch', 'ms', t, t + 60, round(rng.uniform(20, 90), 3)))
+    out.append(record('HKQuantityTypeIdentifierRestingHeartRate', 'Apple Watch', 'count/min', 300, 86000, rng.randint(48, 62)))
+    out.append(record('HKQuantityTypeIdentifierWalkingHeartRateAverage', 'Apple Watch', 'count/min', 300, 86000, rng.randint(85, 110)))
+    if rng.random() < 0.05:
+        t = rng.randint(25200, 30000)
+        out.append(record('HKQuantityTypeIdentifierBodyTemperature', 'iPhone', 'degC', t, t, round(rng.uniform(36.2, 37.4), 1)))
+    # Sleep starts in the late evening and runs past midnight into the next day.
+    t = 79200 + rng.randint(0, 5400)
+    end = 86400 + 21600 + rng.randint(0, 5400)
+    while t < end:
+        length = rng.randint(300, 2700)
+        out.append(record('HKCategoryTypeIdentifierSleepAnalysis', 'Apple Watch', None, t, min(t + length, end), rng.choice(SLEEP_STAGES)))
+        t += length
+    if rng.random() < 0.2:
+        t = rng.randint(25200, 36000)
+        systolic, diastolic = rng.randint(105, 140), rng.randint(65, 92)
+        out.append(f' <Correlation type="HKCorrelationTypeIdentifierBloodPressure" sourceName="Omron" creationDate="{stamp(t)}" startDate="{stamp(t)}" endDate="{stamp(t)}">\n'
+                   f'  <Record type="HKQuantityTypeIdentifierBloodPressureSystolic" sourceName="Omron" unit="mmHg" creationDate="{stamp(t)}" startDate="{stamp(t)}" endDate="{stamp(t)}" value="{systolic}"/>\n'
+                   f'  <Record type="HKQuantityTypeIdentifierBloodPressureDiastolic" sourceName="Omron" unit="mmHg" creationDate="{stamp(t)}" startDate="{stamp(t)}" endDate="{stamp(t)}" value="{diastolic}"/>\n'
+                   ' </Correlation>\n')
+    if rng.random() < 0.4:
+        t = rng.randint(61200, 68400)
+        length = rng.randint(1200, 4800)
+        out.append(f' <Workout workoutActivityType="HKWorkoutActivityTypeRunning" duration="{length / 60:.2f}" durationUnit="min" sourceName="Apple Watch" sourceVersion="10.1" creationDate="{stamp(t + length)}" startDate="{stamp(t)}" endDate="{stamp(t + length)}">\n'
+                   f'  <WorkoutEvent type="HKWorkoutEventTypeSegment" date="{stamp(t)}" duration="{length / 60:.2f}" durationUnit="min"/>\n'
+                   f'  <TotalEnergyBurned value="{length * rng.uniform(0.15, 0.25):.3f}" unit="kcal"/>\n'
+                   ' </Workout>\n')
+    out.append(f' <ActivitySummary dateComponents="{date}" activeEnergyBurned="{rng.uniform(300, 900):.3f}" activeEnergyBurnedGoal="600" activeEnergyBurnedUnit="kcal" appleExerciseTime="{rng.randint(5, 90)}" appleExerciseTimeGoal="30" appleStandHours="{rng.randint(6, 16)}" appleStandHoursGoal="12"/>\n')
+    return ''.join(out)
+
+def day_offset(day):
+    """UTC offset string for a synthetic day: Central European time with DST, plus a trip to New York every few months."""
+    date = EPOCH + timedelta(days=day)
+    if day % 97 < 7:
+        return '-0400' if 3 <= date.month <= 10 else '-0500'
+    return '+0200' if 4 <= date.month <= 9 else '+0100'
+
+def generate_export(path, size, seed=1, end_day=None):
+    """Writes a synthetic export.xml of at least `size` bytes and returns the number of days it covers.
+
+    The content depends only on size, seed and end_day (default: yesterday), so runs with
+    the same arguments on the same day import byte-identical files.
+    """
+    if end_day is None:
+        end_day = day_number(datetime.now()) - 1
+    rng = random.Random(seed)
+    days = max(1, -(-size // len(synthetic_day(random.Random(seed), end_day, '+0000').encode())))
+    day = end_day - days + 1
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        written = f.write(SYNTHETIC_HEADER.format(date=(EPOCH + timedelta(days=end_day + 1)).strftime('%Y-%m-%d'), offset=day_offset(end_day)))
+        while written < size:
+            written += f.write(synthetic_day(rng, day, day_offset(day)))
+            day += 1
+        f.write('</HealthData>\n')
+    return day - (end_day - days + 1)
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def measure_latency(requests_per_endpoint, concurrency):
+    """Issues the benchmark requests from `concurrency` threads and returns p50/p99 latency in ms per endpoint."""
+    jobs = [(name, url.format(days=BENCH_DAYS[i % len(BENCH_DAYS)]))
+            for i in range(requests_per_endpoint) for name, url in BENCH_ENDPOINTS.items()]
+    def timed(job):
+        name, url = job
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        return name, (time.perf_counter() - started) * 1000, response.status_code
+    timings = {name: [] for name in BENCH_ENDPOINTS}
+    errors = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for name, elapsed, status in executor.map(timed, jobs):
+            timings[name].append(elapsed)
+            errors += status != 200
+    wall = time.perf_counter() - started
+    results = {name: {'p50_ms': round(percentile(values, 50), 3), 'p99_ms': round(percentile(values, 99), 3), 'requests': len(values)}
+               for name, values in timings.items()}
+    return {'endpoints': results, 'requests_per_sec': round(len(jobs) / wall, 1), 'errors': errors}
+
+def run_benchmark(size, workers=1, requests_per_endpoint=100, concurrency=8, seed=1, directory=None):
+    """Generates, imports and serves a synthetic export and returns the measurements as a dict."""
+    global XML_FILE, DB_FILE
+    workdir = directory or tempfile.mkdtemp(prefix='health-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    XML_FILE = os.path.join(workdir, 'export.xml')
+    DB_FILE = os.path.join(workdir, 'health.db')
+    for path in (DB_FILE, DB_FILE + '-wal', DB_FILE + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    result = {'config': {'size': size, 'seed': seed, 'workers': workers, 'concurrency': concurrency,
+                         'requests_per_endpoint': requests_per_endpoint, 'parser': 'lxml' if lxml_etree is not None else 'xml.etree',
+                         'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version, 'platform': sys.platform}}
+    try:
+        started = time.perf_counter()
+        days = generate_export(XML_FILE, size, seed)
+        export_size = os.path.getsize(XML_FILE)
+        result['generate'] = {'seconds': round(time.perf_counter() - started, 3), 'export_bytes': export_size, 'days': days}
+
+        # The importer reports progress on stdout, which is reserved for the JSON result.
+        with contextlib.redirect_stdout(sys.stderr):
+            started = time.perf_counter()
+            records = parse_and_import(workers=workers)
+            elapsed = time.perf_counter() - started
+        db_size = sum(os.path.getsize(path) for path in (DB_FILE, DB_FILE + '-wal') if os.path.exists(path))
+        result['import'] = {'seconds': round(elapsed, 3), 'records': records, 'records_per_sec': round((records or 0) / elapsed, 1),
+                            'mb_per_sec': round(export_size / 2**20 / elapsed, 2), 'peak_rss_bytes': peak_rss(),
+                            'peak_worker_rss_bytes': peak_rss(children=True) if workers > 1 else None, 'db_bytes': db_size,
+                            'phases': {name: round(seconds, 3) for name, seconds in import_timer.seconds.items()}}
+
+        # Once with the query cache disabled to time the queries themselves, then as served.
+        pool = get_pool()
+        pool.cache.capacity = 0
+        result['api_uncached'] = measure_latency(requests_per_endpoint, concurrency)
+        pool.cache.capacity = QUERY_CACHE_SIZE
+        pool.cache.hits = pool.cache.misses = 0
+        result['api_cached'] = measure_latency(requests_per_endpoint, concurrency)
+        result['api_cached']['cache'] = pool.cache.stats()
+        result['compaction'] = check_compaction(os.path.join(workdir, 'compaction'), seed)
+    finally:
+        pool = pools.pop(DB_FILE, None)
+        if pool is not None:
+            pool.close()
+        if directory is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+COMPACTION_CHECK_SIZE = 2 * 1024 * 1024
+ROLLUP_TOTALS_QUERY = 'SELECT type_id, ROUND(SUM(sum_value), 6), SUM(sample_count) FROM daily_rollup GROUP BY type_id'
+
+def check_compaction(directory, seed=1):
+    """Regression check for tiered storage: imports an export that ends before the raw retention
+    window, compacts it and imports it again, which must neither add samples nor change daily_rollup.
+    """
+    global XML_FILE, DB_FILE
+    saved = XML_FILE, DB_FILE
+    os.makedirs(directory, exist_ok=True)
+    XML_FILE, DB_FILE = os.path.join(directory, 'export.xml'), os.path.join(directory, 'health.db')
+    try:
+        for path in (DB_FILE, DB_FILE + '-wal', DB_FILE + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        generate_export(XML_FILE, COMPACTION_CHECK_SIZE, seed, day_number(datetime.now()) - RAW_RETENTION_DAYS - 30)
+        totals = []
+        with contextlib.redirect_stdout(sys.stderr):
+            parse_and_import()
+            with sqlite3.connect(DB_FILE) as conn:
+                totals.append(conn.execute(ROLLUP_TOTALS_QUERY).fetchall())
+            started = time.perf_counter()
+            compact_db()
+            elapsed = time.perf_counter() - started
+            with sqlite3.connect(DB_FILE) as conn:
+                totals.append(conn.execute(ROLLUP_TOTALS_QUERY).fetchall())
+                compacted = conn.execute('SELECT SUM(sample_count) FROM samples_1m').fetchone()[0] or 0
+            reimported = parse_and_import()
+        with sqlite3.connect(DB_FILE) as conn:
+            totals.append(conn.execute(ROLLUP_TOTALS_QUERY).fetchall())
+            consistent = reimported == 0 and totals[0] == totals[1] == totals[2] and conn.execute(
+                'SELECT SUM(sample_count) FROM samples_1m').fetchone()[0] == compacted
+    finally:
+        XML_FILE, DB_FILE = saved
+    return {'seconds': round(elapsed, 3), 'samples_compacted': compacted, 'reimported_records': reimported, 'consistent': consistent}
 
 # --- MAIN EXECUTION ---
+def get_option(name, default=None):
+    """Returns the value following '--name' on the command line, or default."""
+    flag = f'--{name}'
+    if flag in sys.argv:
+        index = sys.argv.index(flag)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
 def print_usage():
     print("Usage: python your_script_name.py [command]")
     print("Commands:")
-    print("  import   - Parse export.xml and load data into the database.")
-    print("  serve    - Run the web server to view the dashboard.")
+    print("  import   - Parse export.xml (or export.zip) and load new data into the database (resumes an interrupted import).")
+    print(f"             --profile NAME  Use the profile's own database and export in {PROFILES_DIR}/NAME/ (also for")
+    print("             migrate, compact, export and explain). 'serve' hosts every profile on /u/NAME/.")
+    print("             --file PATH  Import this export.xml or export.zip instead.")
+    print("             --workers N  Parse with N processes (0 = one per CPU core).")
+    print("             --max-rss SIZE  Stop (resumably) if a process grows beyond SIZE, e.g. 1G.")
+    print("             --timezone NAME  Count days, weeks and months in this timezone, e.g. Europe/Berlin,")
+    print("             or 'sample' for each record's own offset (the default). Remembered for later imports.")
+    print("  migrate  - Convert a health.db created by an older version to the compact schema.")
+    print("  compact  - Keep only recent raw samples of high-frequency types such as heart rate, older ones as")
+    print("             per-minute and 5-minute min/max/mean/count rows. Later imports compact automatically.")
+    print(f"             --keep-days N  Raw samples to keep (default {RAW_RETENTION_DAYS}), --minute-days N  per-minute rows (default {MINUTE_RETENTION_DAYS}).")
+    print("  serve    - Run the web server to view the dashboard (and each profile's on /u/NAME/). Metrics are served on /metrics.")
+    print("             --allow-import  Let POST /api/import (or /u/NAME/api/import) import the export in the background;")
+    print("             GET it for progress. Anyone who can reach the server can then start imports.")
+    print("             --server-timing  Add a Server-Timing header (db, json and total time) to every response.")
+    print("             --slow-query-ms N  Log statements slower than N ms (default 250).")
+    print("             --analytics DIR  Answer /api/data and /api/summary from an 'export --format arrow' directory with NumPy.")
+    print("  bench    - Import a generated export and load-test the API; prints the timings as JSON. Also checks that")
+    print("             re-importing a compacted export changes nothing, and fails if it does.")
+    print("             --size SIZE  Size of the synthetic export.xml, e.g. 100M, 1G or 5G (default 100M).")
+    print("             --workers N, --requests N per endpoint, --concurrency N, --seed N,")
+    print("             --dir DIR to keep the generated files, --output FILE to also save the JSON.")
+    print("  export   - Write the samples as columnar files, one directory per type.")
+    print("             --format parquet|arrow (default parquet), --output DIR (default health_export).")
+    print("  explain  - Show the query plan of every statement the API runs; fails on full scans or temp B-trees.")
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print_usage()
         sys.exit(1)
     command = sys.argv[1]
+    PROFILE = get_option('profile')
+    if PROFILE is not None:
+        if not PROFILE_NAME_RE.fullmatch(PROFILE):
+            print(f"Invalid profile name: {PROFILE}. Use letters, digits, '-' and '_'.")
+            sys.exit(1)
+        if command != 'import' and not os.path.exists(profile_files(PROFILE)[0]):
+            print(f"Profile '{PROFILE}' has no database. Import its export with 'import --profile {PROFILE}' first.")
+            sys.exit(1)
+        os.makedirs(os.path.join(PROFILES_DIR, PROFILE), exist_ok=True)
+        DB_FILE, XML_FILE, ZIP_FILE = profile_files(PROFILE)
     if command == 'import':
-        parse_and_import()
-    elif command == 'serve':
-        if not os.path.exists(DB_FILE):
+        workers = int(get_option('workers', 1)) or os.cpu_count() or 1
+        max_rss = get_option('max-rss')
+        parse_and_import(workers=workers, max_rss=parse_size(max_rss) if max_rss else None, timezone=get_option('timezone'),
+                         source=get_option('file'))
+    elif command == 'migrate':
+        migrate_db()
+    elif command == 'compact':
+        compact_db(int(get_option('keep-days', 0)) or None, int(get_option('minute-days', 0)) or None)
+    elif command == 'bench':
+        workers = int(get_option('workers', 1)) or os.cpu_count() or 1
+        result = run_benchmark(parse_size(get_option('size', '100M')), workers=workers,
+                               requests_per_endpoint=int(get_option('requests', 100)),
+                               concurrency=int(get_option('concurrency', 8)),
+                               seed=int(get_option('seed', 1)), directory=get_option('dir'))
+        output = json.dumps(result, indent=2)
+        print(output)
+        if get_option('output'):
+            with open(get_option('output'), 'w') as f:
+                f.write(output + '\n')
+        if not result['compaction']['consistent']:
+            print("Error: re-importing a compacted export changed the database (see 'compaction').", file=sys.stderr)
+            sys.exit(1)
+    elif command == 'export':
+        fmt = get_option('format', 'parquet')
+        if fmt not in ('parquet', 'arrow'):
+            print(f"Unknown export format: {fmt}. Use parquet or arrow.")
+            sys.exit(1)
+        export_columnar(get_option('output', os.path.join(os.path.dirname(DB_FILE), 'health_export')), fmt)
+    elif command in ('serve', 'explain'):
+        # 'serve' hosts DB_FILE on / (if it exists) and every profile on /u/<name>/.
+        shards = [DB_FILE] if command == 'explain' or PROFILE or os.path.exists(DB_FILE) else []
+        if command == 'serve' and PROFILE is None:
+            shards += [profile_files(name)[0] for name in list_profiles()]
+        if not shards or not os.path.exists(shards[0]):
             print(f"Database file '{DB_FILE}' not found. Run the 'import' command first.")
             sys.exit(1)
+        for path in shards:
+            if needs_migration(path):
+                print(f"Database file '{path}' uses an older format. Run the 'migrate' command first.")
+                sys.exit(1)
+            try:
+                timezone = stored_timezone(get_pool(path).connection())
+                if path == DB_FILE:
+                    set_home_timezone(timezone)
+                else:
+                    parse_timezone(timezone)
+            except ValueError as error:
+                print(f"Error: {path}: {error}")
+                sys.exit(1)
+        if command == 'explain':
+            sys.exit(1 if explain_queries() else 0)
+        SERVER_TIMING = '--server-timing' in sys.argv
+        ALLOW_IMPORT = '--allow-import' in sys.argv
+        analytics = get_option('analytics')
+        if analytics:
+            if np is None or pa is None:
+                print("Error: --analytics requires numpy and pyarrow. Please run: pip install numpy pyarrow")
+                sys.exit(1)
+            # A relative DIR is also looked up in each profile's directory, where 'export --profile' writes.
+            for path in shards:
+                directory = os.path.join(os.path.dirname(path), analytics)
+                if path != DB_FILE and (os.path.isabs(analytics) or not os.path.isdir(directory)):
+                    continue
+                pool = get_pool(path)
+                try:
+                    pool.columns = ColumnStore(directory)
+                except (OSError, ValueError, KeyError) as error:
+                    print(f"Error: cannot use {directory} for analytics: {error}")
+                    sys.exit(1)
+                if pool.columns.version != data_version(pool.connection()):
+                    print(f"[WARNING] The analytics export {directory} is older than {path}; using SQLite until it is exported again.")
+        SLOW_QUERY_SECONDS = float(get_option('slow-query-ms', SLOW_QUERY_SECONDS * 1000)) / 1000
+        for name in list_profiles() if PROFILE is None else []:
+            print(f"Serving profile '{name}' on /u/{name}/")
         if serve:
             print("Starting web server on http://0.0.0.0:8080")
             serve(app, host='0.0.0.0', port=8080)